@@ -1,17 +1,85 @@
+import collections
+import json
+import os
+
+import numpy
+
+from .cache import parse_bool, parse_str
 from .instrument import VISAInstrument
+from .scpi import Command, CommandTable
 
 MeasureType = {'vrms', 'vpp', 'vmax', 'vmin', 'vamplitude', 'vaverage', 'vbase', 'vtop', 'vupper', 'vmiddle', }
 
+# :waveform:format -> struct format of one sample on the wire
+WaveformFormat = {
+    'byte': 'b',
+    'word': 'h',
+}
+
+# format field of :waveform:preamble? -> :waveform:format
+WaveformPreambleFormat = {
+    0: 'byte',
+    1: 'word',
+}
+
+# transfer format last sent by Waveform, gone from the cache after a preset like the instrument's setting
+WaveformTransfer = ('waveform_transfer', None, 'format')
+
+# one row of Measure.get_results()
+MeasureResultDType = numpy.dtype([
+    ('name', 'U64'),
+    ('current', numpy.float64),
+    ('min', numpy.float64),
+    ('max', numpy.float64),
+    ('mean', numpy.float64),
+    ('stddev', numpy.float64),
+    ('count', numpy.int64),
+])
+
+MeasureStatistics = {'on', 'current', 'mean', 'maximum', 'minimum', 'stddev', 'count'}
+
+# value reported for a measurement that could not be made
+MEASURE_INVALID = 9.9e37
+
+# fields of :waveform:preamble?
+WaveformPreamble = collections.namedtuple('WaveformPreamble', [
+    'format', 'type', 'points', 'count',
+    'xincrement', 'xorigin', 'xreference',
+    'yincrement', 'yorigin', 'yreference',
+])
+
+# every cached preamble, stale after a channel or timebase change
+WaveformSettings = ('waveform', None, None)
+
+# the get_*/set_* methods of the subsystems are generated from this table, see scpi.CommandTable
+ScopeCommands = CommandTable([
+    Command('channel', 'coupling', ':channel{n}:coupling', parse_str, values={'ac', 'dc'}, check=True,
+            invalidates=[WaveformSettings], default='DC', value_name='coupling'),
+    Command('channel', 'scale', ':channel{n}:scale', float, check=True, invalidates=[WaveformSettings], default=0.1,
+            value_name='scale'),
+    Command('channel', 'display', ':channel{n}:display', parse_bool, check=True, invalidates=[WaveformSettings],
+            default=1),
+    Command('trigger', 'mode', ':trigger:mode', parse_str, check=True, default='EDGE', value_name='mode'),
+    Command('trigger', 'edge_source', ':trigger:edge:source', parse_str, check=True, default='CHAN1',
+            value_name='source'),
+    Command('measure', 'statistics', ':measure:statistics', parse_str, values=MeasureStatistics, check=True,
+            default='ON', value_name='mode'),
+    Command('timebase', 'scale', ':timebase:scale', float, invalidates=[WaveformSettings], default=1e-6,
+            value_name='scale'),
+])
+
 
 class Oscilloscope(VISAInstrument):
-    def __init__(self, usb_visa_address):
+    def __init__(self, usb_visa_address, timeout=None, chunk_size=None, backend=None):
         instrument_name = 'Oscilloscope'
-        super().__init__(usb_visa_address, instrument_name)
+        super().__init__(usb_visa_address, instrument_name, timeout, chunk_size, backend)
         self.system = self.System(self)
         self.channel = self.Channel(self)
         self.trigger = self.Trigger(self)
         self.measure = self.Measure(self)
-
+        self.waveform = self.Waveform(self)
+        self.segmented = self.Segmented(self)
+        self.timebase = self.TimeBase(self)
 
     class System:
         def __init__(self, outer):
@@ -20,30 +88,12 @@ class Oscilloscope(VISAInstrument):
         def preset(self):
             self.outer.do_command(':system:preset')
 
+    @ScopeCommands.subsystem('channel')
     class Channel:
         def __init__(self, outer):
             self.outer = outer
 
-        def set_coupling(self, n, coupling):
-            self.outer.do_command(f':channel{n}:coupling {coupling}')
-
-        def get_coupling(self, n):
-            self.outer.do_command(f':channel{n}:coupling')
-
-        def set_scale(self, n: int, scale: float):
-            self.outer.do_command(f':channel{n}:scale {scale}')
-
-        def get_scale(self, n: int):
-            return self.outer.query_number(f':channel{n}:scale?')
-
-        def set_display(self, n, value):
-            self.outer.do_command(f':channel{n}:display {value}')
-
-        def get_display(self, n: int):
-            return self.outer.query_string(f':channel{n}:display?')
-
-
-
+    @ScopeCommands.subsystem('trigger')
     class Trigger:
         def __init__(self, outer):
             self.outer = outer
@@ -51,34 +101,71 @@ class Oscilloscope(VISAInstrument):
         def set_level_as_setup(self):
             self.outer.do_command(f':trigger:level:asetup')
 
-        def set_mode(self, mode):
-            self.outer.do_command(f':trigger:mode {mode}')
+    @ScopeCommands.subsystem('measure')
+    class Measure:
+        def __init__(self, outer):
+            self.outer = outer
+            # names of the measurements added with the add_* methods, in order
+            self.registered = []
 
-        def get_mode(self):
-            return self.outer.query_string(f':trigger:mode?')
+        def clear(self):
+            self.outer.do_command(':measure:clear')
+            self.registered.clear()
 
-        def set_edge_source(self, source):
-            self.outer.do_command(f':trigger:edge:source {source}')
+        def set_statistics(self, mode='on'):
+            """
+            'on' makes get_results() report current/min/max/mean/stddev/count, any other mode one value.
+            """
+            self.outer.write_command(ScopeCommands['measure', 'statistics'], (), mode)
 
-        def get_edge_source(self):
-            return self.outer.query_string(f':trigger:edge:source?')
+        def reset_statistics(self):
+            self.outer.do_command(':measure:statistics:reset')
+
+        def get_results(self) -> numpy.ndarray:
+            """
+            All added measurements read back with one :measure:results? query.
+            With statistics 'on' every field of MeasureResultDType is filled, otherwise only name and current.
+            Invalid measurements are NaN.
+            """
+            fields = self.outer.do_query_string(':measure:results?').strip().split(',')
+            try:
+                float(fields[0])
+                labeled = False
+            except ValueError:
+                labeled = True
+            width = 7 if labeled else 1
+            rows = len(fields) // width
+            result = numpy.zeros(rows, dtype=MeasureResultDType)
+            for name in ('min', 'max', 'mean', 'stddev'):
+                result[name] = numpy.nan
+            if labeled:
+                table = numpy.array(fields[:rows * width], dtype=object).reshape(rows, width)
+                result['name'] = table[:, 0]
+                for i, name in enumerate(MeasureResultDType.names[1:6], 1):
+                    result[name] = table[:, i].astype(numpy.float64)
+                result['count'] = table[:, 6].astype(numpy.float64)
+            else:
+                result['name'] = (self.registered + [''] * rows)[:rows]
+                result['current'] = numpy.array(fields[:rows], dtype=numpy.float64)
+            for name in MeasureResultDType.names[1:6]:
+                result[name][result[name] >= MEASURE_INVALID] = numpy.nan
+            return result
 
-    class Measure:
-        def __init__(self, outer):
-            self.outer = outer
         # VRMS
         def get_voltage_root_mean_square(self, interval='display', type='DC', source='channel1'):
             return self.outer.do_query_number(f':measure:vrms? {interval},{type},{source}')
 
         def add_voltage_root_mean_square(self, interval='display', type='DC', source='channel1'):
             self.outer.do_command(f':measure:vrms {interval},{type},{source}')
+            self.registered.append(f'vrms({source})')
 
         # Frequency
         def get_frequency(self,  source='channel1'):
-            return self.outer.query_number(f':measure:frequency? {source}')
+            return self.outer.do_query_number(f':measure:frequency? {source}')
 
         def add_frequency(self, source='channel1'):
             self.outer.do_command(f':measure:frequency {source}')
+            self.registered.append(f'frequency({source})')
 
         # VMAX
         def get_voltage_max(self, source='channel1'):
@@ -86,6 +173,7 @@ class Oscilloscope(VISAInstrument):
 
         def add_voltage_max(self, source='channel1'):
             self.outer.do_command(f':measure:vmax {source}')
+            self.registered.append(f'vmax({source})')
 
         # VMIN
         def get_voltage_min(self, source='channel1'):
@@ -93,10 +181,259 @@ class Oscilloscope(VISAInstrument):
 
         def add_voltage_min(self, source='channel1'):
             self.outer.do_command(f':measure:vmin {source}')
+            self.registered.append(f'vmin({source})')
+
+    class Waveform:
+        """
+        Binary waveform transfer. The preamble of each source is cached until a channel, timebase or
+        waveform setting changes, so a repeated capture costs one data transfer.
+        """
+
+        def __init__(self, outer):
+            self.outer = outer
+            self.format = 'byte'
+            self._time_axes = {}
 
+        def digitize(self, *sources, timeout=None):
+            """
+            Acquire once on the given sources (all displayed channels if none) and stop.
+            Completion is signalled by *OPC, see VISAInstrument.wait_complete().
+            :param timeout: seconds, the session timeout if None
+            """
+            self.outer.wait_complete(f':digitize {",".join(sources)}'.strip(), timeout)
+
+        def set_format(self, _format: str = 'byte'):
+            assert _format.lower() in WaveformFormat
+            self.format = _format.lower()
+            self.outer.cache.invalidate(*WaveformTransfer)
+            with self.outer.batch():
+                self._configure()
+            self.outer.cache.put(WaveformTransfer, self.format)
+            self.outer.cache.invalidate('waveform')
+
+        def _configure(self):
+            """
+            Queue the transfer format the samples are decoded with, unless the instrument holds it already.
+            Sent on first use, after set_format() and after a preset.
+            """
+            if self.outer.cache.get(WaveformTransfer) != self.format:
+                self.outer.write(f':waveform:format {self.format}')
+                self.outer.write(':waveform:byteorder lsbfirst')
+                self.outer.write(':waveform:unsigned 0')
+
+        def set_points(self, points: int, mode: str = 'raw'):
+            with self.outer.batch():
+                self.outer.write(f':waveform:points:mode {mode}')
+                self.outer.write(f':waveform:points {points}')
+            self.outer.cache.invalidate('waveform')
+
+        def get_preamble(self, source='channel1') -> WaveformPreamble:
+            key = ('waveform', source, 'preamble')
+            preamble = self.outer.cache.get(key)
+            if not isinstance(preamble, WaveformPreamble):
+                preamble = self._read_preamble(source)
+                if WaveformPreambleFormat.get(preamble.format) != self.format:
+                    # changed on the instrument since it was configured
+                    self.outer.cache.invalidate(*WaveformTransfer)
+                    preamble = self._read_preamble(source)
+                    if WaveformPreambleFormat.get(preamble.format) != self.format:
+                        raise ValueError(f'waveform format {preamble.format} is not {self.format}')
+                self.outer.cache.put(key, preamble)
+            return preamble
+
+        def _read_preamble(self, source) -> WaveformPreamble:
+            # a batch of our own, the response is needed now even inside the caller's batch()
+            with self.outer._unbatched(), self.outer.batch():
+                self._configure()
+                self.outer.write(f':waveform:source {source}')
+                response = self.outer.query(':waveform:preamble?')
+            self.outer.cache.put(WaveformTransfer, self.format)
+            values = [float(value) for value in response.result().split(',')]
+            return WaveformPreamble(*map(int, values[:4]), *values[4:])
+
+        def get_raw(self, source='channel1') -> numpy.ndarray:
+            """
+            Samples of the last acquisition as signed integers, one query per call.
+            """
+            with self.outer._unbatched(), self.outer.batch():
+                self._configure()
+                self.outer.write(f':waveform:source {source}')
+                data = self.outer.query_binary_array(':waveform:data?', WaveformFormat[self.format])
+            self.outer.cache.put(WaveformTransfer, self.format)
+            return data.result()
+
+        def get_time(self, source='channel1') -> numpy.ndarray:
+            preamble = self.get_preamble(source)
+            time = self._time_axes.get(preamble)
+            if time is None:
+                time = (numpy.arange(preamble.points) - preamble.xreference) * preamble.xincrement + preamble.xorigin
+                self._time_axes = {preamble: time}
+            return time
+
+        def get_voltage(self, source='channel1') -> numpy.ndarray:
+            raw = self.get_raw(source)
+            preamble = self.get_preamble(source)
+            if preamble.points != len(raw):
+                # the record length changed behind our back
+                self.outer.cache.invalidate('waveform', source)
+                preamble = self.get_preamble(source)
+            return (raw - preamble.yreference) * preamble.yincrement + preamble.yorigin
+
+        def capture(self, source='channel1', digitize=True):
+            """
+            :return: (time in s, voltage in V) of one acquisition of source
+            """
+            if digitize:
+                self.digitize(source)
+            voltage = self.get_voltage(source)
+            return self.get_time(source), voltage
+
+        def capture_multiple(self, sources=('channel1',), digitize=True) -> numpy.ndarray:
+            """
+            Acquire all sources at once.
+            :return: structured array with a 'time' field and one voltage field per source
+            """
+            if digitize:
+                self.digitize(*sources)
+            voltages = [self.get_voltage(source) for source in sources]
+            result = numpy.empty(len(voltages[0]), dtype=[('time', numpy.float64)] +
+                                                         [(source, numpy.float64) for source in sources])
+            result['time'] = self.get_time(sources[0])
+            for source, voltage in zip(sources, voltages):
+                result[source] = voltage
+            return result
+
+    class Segmented:
+        """
+        Segmented memory and long record acquisition streamed into memory-mapped .npy files,
+        host memory stays bounded by one transfer chunk whatever the record size.
+        A capture directory holds data.npy (raw samples, one row per segment), ttag.npy (segment time tags in s)
+        and preamble.json, open it with open_segmented().
+        """
+
+        def __init__(self, outer):
+            self.outer = outer
+
+        def set_count(self, count: int):
+            with self.outer.batch():
+                self.outer.write(':acquire:mode segmented')
+                self.outer.write(f':acquire:segmented:count {count}')
+            self.outer.cache.invalidate('waveform')
+
+        def disable(self):
+            self.outer.write(':acquire:mode rtime')
+            self.outer.cache.invalidate('waveform')
+
+        def get_acquired_count(self) -> int:
+            return int(float(self.outer.query(':waveform:segmented:count?')))
+
+        def capture(self, path, source='channel1', count=None, digitize=True, progress=None):
+            """
+            Acquire count segments of source (or use the last acquisition) and stream them into path.
+            :param progress: called as progress(segments done, segments total)
+            :return: SegmentedRecord opened on path
+            """
+            # the segment index and time tag are needed now, even inside the caller's batch()
+            with self.outer._unbatched():
+                if count is not None:
+                    self.set_count(count)
+                if digitize:
+                    self.outer.waveform.digitize(source)
+                segments = self.get_acquired_count()
+                preamble = self.outer.waveform.get_preamble(source)
+                data, ttag = self._create(path, preamble, segments)
+                for i in range(segments):
+                    with self.outer.batch():
+                        self.outer.write(f':acquire:segmented:index {i + 1}')
+                        time_tag = self.outer.query(':waveform:segmented:ttag?')
+                    ttag[i] = float(time_tag.result())
+                    length = self.outer.read_ieee_block_into(f':waveform:source {source};:waveform:data?', data[i])
+                    self._check_length(length, data[i], i + 1)
+                    if progress is not None:
+                        progress(i + 1, segments)
+            data.flush()
+            ttag.flush()
+            del data, ttag
+            return open_segmented(path)
+
+        def capture_long(self, path, source='channel1', points=None, digitize=True, progress=None):
+            """
+            Acquire one long record (raw points mode) and stream it into path in chunks.
+            :param points: record length, the maximum available if None
+            :param progress: called as progress(bytes done, bytes total)
+            :return: SegmentedRecord opened on path, with a single segment
+            """
+            self.outer.waveform.set_points(points if points is not None else 'max', 'raw')
+            if digitize:
+                self.outer.waveform.digitize(source)
+            preamble = self.outer.waveform.get_preamble(source)
+            data, ttag = self._create(path, preamble, 1)
+            length = self.outer.read_ieee_block_into(f':waveform:source {source};:waveform:data?', data[0],
+                                                     progress=progress)
+            self._check_length(length, data[0], 1)
+            data.flush()
+            ttag.flush()
+            del data, ttag
+            return open_segmented(path)
+
+        @staticmethod
+        def _check_length(length, segment, index):
+            """
+            A short block would leave the rest of the preallocated segment zero.
+            """
+            if length != segment.nbytes:
+                raise ValueError(f'segment {index}: {length} bytes received, {segment.nbytes} expected '
+                                 f'from the preamble')
+
+        def _create(self, path, preamble, segments):
+            os.makedirs(path, exist_ok=True)
+            with open(os.path.join(path, 'preamble.json'), 'w') as f:
+                json.dump(preamble._asdict(), f)
+            dtype = numpy.dtype(WaveformFormat[self.outer.waveform.format]).newbyteorder('<')
+            data = numpy.lib.format.open_memmap(os.path.join(path, 'data.npy'), mode='w+', dtype=dtype,
+                                                shape=(segments, preamble.points))
+            ttag = numpy.lib.format.open_memmap(os.path.join(path, 'ttag.npy'), mode='w+', dtype=numpy.float64,
+                                                shape=(segments,))
+            return data, ttag
+
+    @ScopeCommands.subsystem('timebase')
     class TimeBase:
         def __init__(self, outer):
             self.outer = outer
 
     def set_timebase(self, timebase):
-        self.write(f':timebase:scale {timebase}')
+        self.timebase.set_scale(timebase)
+
+
+class SegmentedRecord(object):
+    """
+    Lazily opened segmented capture, see Oscilloscope.Segmented.
+    data is a read-only memmap of raw samples shaped (segments, points), ttag the segment time tags in s.
+    """
+
+    def __init__(self, data, ttag, preamble: WaveformPreamble):
+        self.data = data
+        self.ttag = ttag
+        self.preamble = preamble
+
+    def __len__(self):
+        return len(self.data)
+
+    def time(self) -> numpy.ndarray:
+        preamble = self.preamble
+        return (numpy.arange(self.data.shape[1]) - preamble.xreference) * preamble.xincrement + preamble.xorigin
+
+    def voltage(self, index=slice(None)) -> numpy.ndarray:
+        """
+        Scaled voltage of the selected segments, only those are read from disk.
+        """
+        preamble = self.preamble
+        return (self.data[index] - preamble.yreference) * preamble.yincrement + preamble.yorigin
+
+
+def open_segmented(path) -> SegmentedRecord:
+    with open(os.path.join(path, 'preamble.json')) as f:
+        preamble = WaveformPreamble(**json.load(f))
+    data = numpy.load(os.path.join(path, 'data.npy'), mmap_mode='r')
+    ttag = numpy.load(os.path.join(path, 'ttag.npy'), mmap_mode='r')
+    return SegmentedRecord(data, ttag, preamble)
@@ -1,9 +1,83 @@
+import threading
+import time
+
+import numpy
 import serial
 
+from .stream import SampleRingBuffer
+
+# sampling rate in SPS of each configure() sps code
+SampleRate = (500000, 200000, 100000, 50000, 20000, 10000, 5000, 2000, 1000)
+
+# data frame: 0x10 0x08 0x02 <power high byte> <power low byte> <checksum>
+# power high byte: sign bit + integer dBm, low byte: hundredths of a dB,
+# checksum: low byte of the sum of bytes 02-04, like the configuration frame
+DATA_FRAME_HEADER = bytes([0x10, 0x08, 0x02])
+DATA_FRAME_SIZE = 6
+
+# bytes per serial.read() of the reader thread
+READ_CHUNK_SIZE = 64 * 1024
+
+
+def encode_dbm(value) -> bytearray:
+    """
+    dBm to the two byte sign-magnitude format of the device, e.g. -25.5 -> 0x99 0x32
+    """
+    magnitude = round(abs(value) * 100)
+    high = (magnitude // 100) & 0x7F
+    if value < 0:
+        high |= 0x80
+    return bytearray([high, magnitude % 100])
+
+
+def decode_frames(buffer):
+    """
+    Decode every valid data frame in buffer at once.
+    Bytes that do not belong to a frame with a valid checksum are skipped, which resynchronizes the stream
+    after corrupt or lost bytes.
+    :param buffer: bytes-like
+    :return: (power in dBm, bytes consumed, bytes skipped), bytes after consumed may start an incomplete frame
+    """
+    data = numpy.frombuffer(buffer, dtype=numpy.uint8)
+    starts = len(data) - DATA_FRAME_SIZE + 1
+    if starts <= 0:
+        return numpy.empty(0), 0, 0
+    header = numpy.ones(starts, dtype=bool)
+    for i, value in enumerate(DATA_FRAME_HEADER):
+        header &= data[i:i + starts] == value
+    candidates = numpy.flatnonzero(header)
+    high = data[candidates + 3]
+    low = data[candidates + 4]
+    checksum = (data[candidates + 2].astype(numpy.uint16) + high + low) & 0xFF
+    valid = candidates[checksum == data[candidates + 5]]
+    if len(valid) > 1:
+        # a header pattern inside the payload of an accepted frame is not a frame
+        valid = valid[numpy.concatenate(([True], numpy.diff(valid) >= DATA_FRAME_SIZE))]
+    high = data[valid + 3]
+    power = (high & 0x7F) + data[valid + 4] / 100
+    power[high & 0x80 != 0] *= -1
+    consumed = max(starts, valid[-1] + DATA_FRAME_SIZE if len(valid) else 0)
+    return power, consumed, consumed - len(valid) * DATA_FRAME_SIZE
+
 
 class PowerMonitor(object):
-    def __init__(self, serial_address):
-        self.serial = serial.Serial(serial_address, 115200, )
+    def __init__(self, serial_address, buffer_size=1 << 22, read_timeout=0.02, port=None):
+        """
+        :param buffer_size: samples kept in the ring buffer until read
+        :param read_timeout: seconds a bulk read of the reader thread waits for more bytes
+        :param port: already opened serial port object used instead of opening serial_address, e.g. a FakeSerial
+        """
+        self.serial = port if port is not None else serial.Serial(serial_address, 115200, timeout=read_timeout)
+        self.buffer = SampleRingBuffer(buffer_size)
+        self.sample_rate = None
+        self.trigger_level = None
+        self.frames = 0
+        self.skipped_bytes = 0
+        self._pending = bytearray()
+        self._thread = None
+        self._stop = threading.Event()
+        self._error = None
+        self._listeners = []
 
     def configure(self, freq, sps, trigger, trigger_level=-30):
         """
@@ -19,11 +93,7 @@ class PowerMonitor(object):
         command_sample = bytearray([sps])
         command_trigger = bytearray([trigger])
         # 将dbm转换为十六进制
-        if trigger_level < 0:
-            trigger_level = 0x80 | (trigger_level & 0x7F)
-        else:
-            trigger_level = 0x00 | (trigger_level & 0x7F)
-        command_trigger_level = bytearray([trigger_level, 0x00])
+        command_trigger_level = encode_dbm(trigger_level)
         command_reserved = bytearray([0x00])
         # 校验位 02- 09 求和取低八位
         checksum = (
@@ -35,6 +105,97 @@ class PowerMonitor(object):
                 sum(command_reserved)
         ) & 0xFF
 
-        command_checksum = bytearray([0x00])
+        command_checksum = bytearray([checksum])
+        self.serial.write(command_frame_header + command_freq + command_sample + command_trigger +
+                          command_trigger_level + command_reserved + command_checksum)
+        self.serial.flush()
+        self.sample_rate = SampleRate[sps]
+        self.trigger_level = trigger_level
+
+    def start(self):
+        """
+        Start the reader thread, decoded samples are collected in buffer until read.
+        """
+        if self._thread is not None:
+            return self
+        self._stop.clear()
+        self._pending.clear()
+        self.serial.reset_input_buffer()
+        self._thread = threading.Thread(target=self._run, name='PowerMonitor', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def close(self):
+        self.stop()
+        self.buffer.close()
+        self.serial.close()
+
+    def add_listener(self, listener):
+        """
+        Call listener(timestamps, power) on the reader thread for every decoded sample batch,
+        it has to return quickly to keep up with the sample rate.
+        """
+        self._listeners = self._listeners + [listener]
+
+    def remove_listener(self, listener):
+        self._listeners = [other for other in self._listeners if other is not listener]
+
+    def read(self, n=None, timeout=None):
+        """
+        :param n: number of samples to wait for, everything buffered if None
+        :param timeout: seconds to wait for n samples
+        :return: (timestamps in s since the epoch, power in dBm), fewer than n samples after a timeout
+        """
+        if self._error is not None:
+            raise self._error
+        return self.buffer.get(n, timeout)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __iter__(self):
+        """
+        Yield (timestamps, power) blocks as they arrive until stop().
+        """
+        self.start()
+        while self._thread is not None or len(self.buffer):
+            timestamps, power = self.read(1, timeout=0.5)
+            if len(power):
+                rest = self.read()
+                yield numpy.concatenate((timestamps, rest[0])), numpy.concatenate((power, rest[1]))
 
+    def _run(self):
+        try:
+            while not self._stop.is_set():
+                data = self.serial.read(max(self.serial.in_waiting, READ_CHUNK_SIZE))
+                if not data:
+                    continue
+                now = time.time()
+                self._pending += data
+                power, consumed, skipped = decode_frames(self._pending)
+                del self._pending[:consumed]
+                self.frames += len(power)
+                self.skipped_bytes += skipped
+                if len(power):
+                    self._publish(now, power)
+        except Exception as e:
+            self._error = e
+        finally:
+            self.buffer.close()
 
+    def _publish(self, now, power):
+        # the last sample of a read arrived just before now, the others one sample period apart
+        period = 1.0 / self.sample_rate if self.sample_rate else 0.0
+        timestamps = now - period * numpy.arange(len(power) - 1, -1, -1)
+        self.buffer.put(timestamps, power)
+        for listener in self._listeners:
+            listener(timestamps, power)
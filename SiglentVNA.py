@@ -1,7 +1,16 @@
+import io
 import pyvisa
 import logging
 
+import numpy
+
+from .analytics import marker_values
+from .cache import parse_bool, parse_int, parse_str, MISSING
+from .conversion import TraceAcquisition, TraceConversion, trace_format_name
 from .instrument import VISAInstrument
+from .scpi import INDEX, Command, CommandTable, short_form
+from .stream import SweepStream
+from .touchstone import write_touchstone
 
 TraceDataFormat = {
     'mlogarithmic',  # Logarithmic magnitude
@@ -23,12 +32,96 @@ TraceDataFormat = {
     'pphase',  # Positive phase
 }
 
+# struct format of one element on the wire for each binary transmission format
+BinaryDataType = {
+    'real': 'd',  # 64-bit float
+    'real32': 'f',  # 32-bit float
+}
+
+
+# one row of a segment sweep table, see Sweep.set_segment_table()
+SegmentDType = numpy.dtype([
+    ('start', numpy.float64),  # Hz
+    ('stop', numpy.float64),  # Hz
+    ('points', numpy.int64),
+    ('ifbw', numpy.float64),  # Hz
+    ('power', numpy.float64),  # dBm
+    ('dwell', numpy.float64),  # s
+])
+
+# :sense:segment:data header: format version, start/stop mode, ifbw/power/dwell/sweep time columns present
+SEGMENT_DATA_HEADER = (5, 0, 1, 1, 1, 0)
+
+# AVGBW.wait_complete() timeout: expected time x factor + offset in s, covers retrace and settling
+AVERAGE_TIMEOUT_FACTOR = 2.0
+AVERAGE_TIMEOUT_OFFSET = 1.0
+
+TriggerSource = {'internal', 'external', 'manual', 'bus'}
+
+SweepType = {'linear', 'logarithmic', 'segment', 'power', 'cw'}
+
+SnpFormat = {'auto', 'ma', 'db', 'ri'}
+
+InstrumentType = {'vna', 'sa', 'smm'}
+
+FrequencyRange = ('start', 'stop', 'center', 'span')
+
+# the get_*/set_* methods of the subsystems are generated from this table, see scpi.CommandTable
+VNACommands = CommandTable([
+    Command('system', 'display_clock', ':display:clock', parse_bool, default=1, value_name='state'),
+    Command('trigger', 'source', ':trigger:source', parse_str, values=TriggerSource, default='INT',
+            value_name='source'),
+    Command('trigger', 'continuous', ':initiate{cnum}:continuous', parse_bool, default=1, value_name='state'),
+    Command('trigger', 'average', ':trigger:average', parse_bool, default=0, value_name='state',
+            doc='With trigger averaging on, single() runs all sweeps of the average instead of one.'),
+    Command('average', 'state', ':sense{cnum}:average:state', parse_bool, default=0, value_name='state'),
+    Command('average', 'count', ':sense{cnum}:average:count', parse_int, default=1, value_name='count'),
+    Command('sweep', 'points', ':sense{cnum}:sweep:points', parse_int, default=201, value_name='points'),
+    Command('sweep', 'type', ':sense{cnum}:sweep:type', parse_str, values=SweepType,
+            invalidates=[('sweep', INDEX, 'points')], default='LIN', value_name='sweep_type'),
+    Command('sweep', 'time_auto', ':sense{cnum}:sweep:time:auto', parse_bool, default=1, value_name='state'),
+    # recalculated by the instrument with auto sweep time whenever span, IFBW, averaging or segments change
+    Command('sweep', 'time', ':sense{cnum}:sweep:time', float, cacheable=False,
+            invalidates=[('sweep', INDEX, 'time_auto')], default=0.0, value_name='time'),
+    Command('power', 'rf_excitation', ':output:state', parse_bool, default=1, value_name='state'),
+    Command('power', 'level', ':source{cnum}:power', float, fmt='.2f', method='channel_power', default=0.0,
+            value_name='power'),
+    Command('power', 'start', ':source{cnum}:power:start', float, fmt='.2f', method='power_sweep_start',
+            default=-10.0, value_name='power'),
+    Command('power', 'stop', ':source{cnum}:power:stop', float, fmt='.2f', method='power_sweep_stop', default=0.0,
+            value_name='power'),
+    # start/stop and center/span describe the same range, setting one changes the others
+    *[Command('frequency', parameter, f':sense{{cnum}}:frequency:{parameter}', float, default=default,
+              invalidates=[('frequency', INDEX, other) for other in FrequencyRange if other != parameter],
+              value_name='frequency')
+      for parameter, default in zip(FrequencyRange, (1e6, 3e9, 1.5005e9, 2.999e9))],
+    Command('frequency', 'cw', ':sense{cnum}:frequency:cw', float, default=1e9, value_name='frequency'),
+    Command('format', 'trace_format', ':calculate{cnum}:trace{tnum}:format', parse_str, values=TraceDataFormat,
+            default='MLOG'),
+    Command('format', 'transmission_format', ':format:data', parse_str, values={'ascii', 'real', 'real32'},
+            default='ascii'),
+    Command('marker', 'state', ':calculate{cnum}:measure{tnum}:marker{mnum}:state', parse_bool, cacheable=False,
+            value_name='state'),
+    Command('marker', 'x', ':calculate{cnum}:trace{tnum}:marker{mnum}:x', float, cacheable=False,
+            method='x_value'),
+    Command('scale', 'division', ':display:window{wnum}:trace{tnum}:y:pdivision', float, method='scale_division',
+            default=10.0, value_name='division', doc='Set the scale division of the trace'),
+    Command('scale', 'reference_level', ':display:window{wnum}:trace{tnum}:y:rlevel', float,
+            method='scale_reference_level', default=0.0, value_name='level'),
+    Command('measure', 'instrument_type', ':calculate{cnum}:instrument', parse_str, values=InstrumentType,
+            default='VNA', value_name='instrument_type'),
+    Command('measure', 'parameter', ':calculate{cnum}:parameter{tnum}:define', parse_str, default='S11',
+            value_name='parameter'),
+    Command('mmemory', 'snp_format', ':mmemory:store:snp:format', parse_str, values=SnpFormat, default='AUTO',
+            value_name='_type', value_default='auto'),
+])
+
 
 # noinspection SpellCheckingInspection
 class SiglentVNA(VISAInstrument):
-    def __init__(self, usb_visa_address):
+    def __init__(self, usb_visa_address, timeout=None, chunk_size=None, backend=None):
         instrument_name = 'Signal VNA'
-        super().__init__(usb_visa_address, instrument_name)
+        super().__init__(usb_visa_address, instrument_name, timeout, chunk_size, backend)
         self.markers = self.Marker(self)
         self.sweep = self.Sweep(self)
         self.avg = self.AVGBW(self)
@@ -39,35 +132,42 @@ class SiglentVNA(VISAInstrument):
         self.save_recall = self.SaveRcall(self)
         self.format = self.Format(self)
         self.scale = self.Scale(self)
+        self.trigger = self.Trigger(self)
+
+    def stream(self, cnum=1, tnum=1, count=None, depth=8, policy='block', timeout=None,
+               sweep_timeout=None) -> SweepStream:
+        """
+        Repeated single sweeps of a trace, see SweepStream.
+        for timestamp, data in vna.stream(1, 1, count=100): ...
+        """
+        return SweepStream(self, cnum, tnum, count, depth, policy, timeout, sweep_timeout)
 
+    @VNACommands.subsystem('system')
     class System:
         def __init__(self, outer):
             self.outer = outer
 
         def preset(self):
             self.outer.write(':system:preset')
+            self.outer.cache.invalidate()
 
-        def set_display_clock(self, state: bool):
-            self.outer.write(f':display:clock {int(state)}')
-
-        def get_display_clock(self):
-            return self.outer.query(':display:clock?')
+    @VNACommands.subsystem('trigger')
+    class Trigger:
+        TriggerSource = TriggerSource
 
-    class AVGBW:
         def __init__(self, outer):
             self.outer = outer
 
-        def get_state(self, cnum):
-            return self.outer.query(f':sense{cnum}:average:state?')
-
-        def set_state(self, cnum, state: bool):
-            self.outer.write(f':sense{cnum}:average:state {int(state)}')
-
-        def set_count(self, cnum, count: int):
-            self.outer.write(f':sense{cnum}:average:count {count}')
+        def single(self):
+            """
+            Trigger one sweep, *OPC? returns once it is complete.
+            """
+            self.outer.write(':trigger:single')
 
-        def get_count(self, cnum):
-            return self.outer.query(f':sense{cnum}:average:count?')
+    @VNACommands.subsystem('average')
+    class AVGBW:
+        def __init__(self, outer):
+            self.outer = outer
 
         def get_current(self, cnum):
             return int(self.outer.query(f':sense{cnum}:average:count?'))
@@ -78,111 +178,125 @@ class SiglentVNA(VISAInstrument):
         def clear(self, cnum):
             self.outer.write(f':sense{cnum}:average:clear')
 
+        def get_expected_time(self, cnum) -> float:
+            """
+            Seconds a full average takes, sweep time x average count.
+            """
+            with self.outer._unbatched():
+                count = self.get_count(cnum) if self.get_state(cnum) else 1
+                return self.outer.sweep.get_time(cnum) * max(count, 1)
+
+        def wait_complete(self, cnum, timeout=None) -> float:
+            """
+            Restart averaging, trigger and wait for the full average on *OPC (a service request where possible)
+            instead of polling complete(). Needs the trigger source on bus and Trigger.set_average(True).
+            :param timeout: seconds, derived from get_expected_time() if None
+            :return: seconds until the average was complete
+            """
+            if timeout is None:
+                timeout = self.get_expected_time(cnum) * AVERAGE_TIMEOUT_FACTOR + AVERAGE_TIMEOUT_OFFSET
+            self.clear(cnum)
+            return self.outer.wait_complete(':trigger:single', timeout)
+
+    @VNACommands.subsystem('sweep')
     class Sweep:
-        SweepType = {'linear', 'logarithmic', 'segment', 'power', 'cw'}
+        SweepType = SweepType
 
         def __init__(self, outer):
             self.outer = outer
 
-        def get_points(self, cnum):
-            return self.outer.query(f':sense{cnum}:sweep:points?')
-
-        def set_points(self, cnum, points: int):
-            self.outer.write(f':sense{cnum}:sweep:points {points}')
-
-        def set_type(self, cnum, sweep_type: str):
-            assert sweep_type.lower() in self.SweepType
-            self.outer.write(f':sense{cnum}:sweep:type {sweep_type}')
-
-        def get_type(self, cnum):
-            return self.outer.query(f':sense{cnum}:sweep:type?')
-
-        def set_time_auto(self, cnum, state):
-            self.outer.write(f':sense{cnum}:sweep:time:auto {int(state)}')
-
-        def get_time_auto(self, cnum):
-            self.outer.query(f':sense{cnum}:sweep:time:auto?')
-
-        def set_time(self, cnum, time: int):
-            self.outer.write(f':sense{cnum}:sweep:time {time}')
-
-        def get_time(self, cnum):
-            return self.outer.query(f':sense{cnum}:sweep:time?')
-
+        def set_segment_table(self, cnum, table):
+            """
+            Upload a whole segment sweep table with one :sense:segment:data command.
+            A table identical to the last one uploaded or read back is not sent again.
+            resync_cache() does not read the table back, the response is a binary block in REAL/REAL32 format.
+            :param table: SegmentDType array, or rows of (start, stop, points, ifbw, power, dwell)
+            """
+            table = self.as_segment_table(table)
+            key = ('sweep', cnum, 'segment_data')
+            if self.outer.cache.get(key) == table.tobytes():
+                return
+            values = SEGMENT_DATA_HEADER + (len(table),)
+            argument = ','.join(map(str, values))
+            if len(table):
+                row = ',%.12g,%.12g,%d,%.12g,%.12g,%.12g'
+                argument += (row * len(table)) % tuple(value for record in table.tolist() for value in record)
+            self.outer._write_setting(key, f':sense{cnum}:segment:data {argument}', table.tobytes(), None, None,
+                                      [('sweep', cnum, 'points')], False)
+
+        def get_segment_table(self, cnum) -> numpy.ndarray:
+            """
+            Segment sweep table read back with one query, as a SegmentDType array.
+            """
+            key = ('sweep', cnum, 'segment_data')
+            data = self.outer.cache.get(key) if self.outer.cache.enabled else MISSING
+            if data is MISSING:
+                with self.outer._unbatched():
+                    data = self._parse_segment_data(self.outer.format._query_ndarray(f':sense{cnum}:segment:data?'))
+                self.outer.cache.put(key, data)
+            return numpy.frombuffer(data, dtype=SegmentDType)
+
+        @staticmethod
+        def as_segment_table(table) -> numpy.ndarray:
+            if isinstance(table, numpy.ndarray) and table.dtype.names:
+                return numpy.ascontiguousarray(table, dtype=SegmentDType)
+            rows = numpy.asarray(table, dtype=numpy.float64).reshape(-1, len(SegmentDType.names))
+            result = numpy.empty(len(rows), dtype=SegmentDType)
+            for i, name in enumerate(SegmentDType.names):
+                result[name] = rows[:, i]
+            return result
+
+        @staticmethod
+        def _parse_segment_data(data) -> bytes:
+            """
+            :sense:segment:data values (text or array) -> bytes of a SegmentDType array
+            """
+            if isinstance(data, str):
+                data = numpy.array(data.strip().split(','), dtype=numpy.float64)
+            data = numpy.asarray(data, dtype=numpy.float64)
+            _, mode, ifbw, power, dwell, sweep_time, n = data[:7].astype(int)
+            columns = ['start', 'stop', 'points'] + [name for name, present in
+                                                     (('ifbw', ifbw), ('power', power), ('dwell', dwell),
+                                                      ('sweep_time', sweep_time)) if present]
+            rows = data[7:7 + n * len(columns)].reshape(n, len(columns))
+            table = numpy.zeros(n, dtype=SegmentDType)
+            for i, name in enumerate(columns):
+                if name in SegmentDType.names:
+                    table[name] = rows[:, i]
+            if mode == 1:
+                # center/span mode
+                center, span = table['start'].copy(), table['stop'].copy()
+                table['start'], table['stop'] = center - span / 2, center + span / 2
+            return table.tobytes()
+
+    @VNACommands.subsystem('power')
     class Power:
         def __init__(self, outer):
             self.outer = outer
 
-        def set_rf_excitation(self, state):
-            self.outer.write(f':output:state {int(state)}')
-
-        def get_rf_excitation(self):
-            return self.outer.query(':output:state?')
-
-        def set_channel_power(self, cnum, power: float):
-            self.outer.write(f':source{cnum}:power {power:.2f}')
-
-        def get_channel_power(self, cnum):
-            return self.outer.query(f':source{cnum}:power?')
-
-        def set_power_sweep_start(self, cnum, power: float):
-            self.outer.write(f':source{cnum}:power:start {power:.2f}')
-
-        def get_power_sweep_start(self, cnum):
-            return self.outer.query(f':source{cnum}:power:start?')
-
-        def set_power_sweep_stop(self, cnum, power: float):
-            self.outer.write(f':source{cnum}:power:stop {power:.2f}')
-
-        def get_power_sweep_stop(self, cnum):
-            return self.outer.query(f':source{cnum}:power:stop?')
-
+    @VNACommands.subsystem('frequency')
     class Frequency:
         def __init__(self, outer):
             self.outer = outer
 
-        def get_start(self, cnum):
-            return self.outer.query(f':sense{cnum}:frequency:start?')
-
-        def set_start(self, cnum, frequency: float):
-            self.outer.write(f':sense{cnum}:frequency:start {frequency}')
-
-        def get_stop(self, cnum):
-            return self.outer.query(f':sense{cnum}:frequency:stop?')
-
-        def set_stop(self, cnum, frequency: float):
-            self.outer.write(f':sense{cnum}:frequency:stop {frequency}')
-
-        def get_center(self, cnum):
-            return self.outer.query(f':sense{cnum}:frequency:center?')
-
-        def set_center(self, cnum, frequency: float):
-            self.outer.write(f':sense{cnum}:frequency:center {frequency}')
-
-        def get_span(self, cnum):
-            return self.outer.query(f':sense{cnum}:frequency:span?')
-
-        def set_span(self, cnum, frequency: float):
-            self.outer.write(f':sense{cnum}:frequency:span {frequency}')
-
-        def get_cw(self, cnum):
-            return self.outer.query(f':sense{cnum}:frequency:cw?')
-
-        def set_cw(self, cnum, frequency: float):
-            self.outer.write(f':sense{cnum}:frequency:cw {frequency}')
-
+    @VNACommands.subsystem('mmemory')
     class SaveRcall:
+        SnpFormat = SnpFormat
+
         def __init__(self, outer):
             self.outer = outer
 
         def load_correction(self, filename):
             self.outer.do_command(f':mmemory:load:correction "{filename}"')
+            self.outer.cache.invalidate()
 
         def load_csarchive(self, filename):
             self.outer.do_command(f':mmemory:load:csarchive "{filename}"')
+            self.outer.cache.invalidate()
 
         def load(self, filename):
             self.outer.write(f':mmemory:load "{filename}"')
+            self.outer.cache.invalidate()
 
         def store_csarchive(self, filename):
             """
@@ -224,22 +338,31 @@ class SiglentVNA(VISAInstrument):
             """
             self.outer.do_command(f':mmemory:store:fdata "{filename}"')
 
-        def transfer_read(self, filename) -> str:
+        def transfer_read(self, filename, file=None, progress=None):
             """
-            将数据写入文件或从文件读取数据。
+            从仪器读取文件，以二进制块分段传输。
             :param filename: 表示文件名。
-            :return:
+            :param file: 写入数据的文件对象，为None时返回bytes
+            :param progress: progress(已传输字节数, 总字节数)
+            :return: file为None时返回文件内容，否则返回字节数
             """
-            return self.outer.query(f':mmemory:transfer? "{filename}"')
-
-        def transfer_write(self, filename, block):
-            raise NotImplementedError("This function is not implemented in the original code.")
-
-        def set_snp_format(self, _type: str = 'auto'):
-            raise NotImplementedError("This function is not implemented in the original code.")
+            if file is None:
+                buffer = io.BytesIO()
+                self.outer.read_ieee_block_to(f':mmemory:transfer? "{filename}"', buffer, progress=progress)
+                return buffer.getvalue()
+            return self.outer.read_ieee_block_to(f':mmemory:transfer? "{filename}"', file, progress=progress)
 
-        def get_snp_format(self):
-            raise NotImplementedError("This function is not implemented in the original code.")
+        def transfer_write(self, filename, block, progress=None) -> int:
+            """
+            将数据写入仪器上的文件，以二进制块分段传输。
+            :param filename: 表示文件名。
+            :param block: bytes或文件对象
+            :param progress: progress(已传输字节数, 总字节数)
+            :return: 字节数
+            """
+            if isinstance(block, (bytes, bytearray, memoryview)):
+                block = io.BytesIO(block)
+            return self.outer.write_ieee_block_from(f':mmemory:transfer "{filename}",', block, progress=progress)
 
         def store_snp(self, filename):
             """
@@ -253,6 +376,28 @@ class SiglentVNA(VISAInstrument):
             """
             self.outer.write(f':mmemory:store:snp "{filename}"')
 
+        def store_snp_local(self, file, cnum=1, nports=2, tnums=None, fmt='RI', z0=50.0):
+            """
+            Write a Touchstone file on the host from one multiple-trace fetch, without storing it on the instrument.
+            The traces are switched to SCOMPLEX format.
+            :param file: path or text file object
+            :param nports: 1 to 4
+            :param tnums: traces measuring S11, S12, ..., Snn row by row, 1 to nports**2 if None
+            :param fmt: 'RI', 'MA' or 'DB'
+            :param z0: reference impedance written to the option line
+            """
+            tnums = list(tnums) if tnums is not None else list(range(1, nports * nports + 1))
+            assert len(tnums) == nports * nports
+            trace_format = self.outer.format
+            with self.outer.batch():
+                for tnum in tnums:
+                    trace_format.set_trace_format(cnum, tnum, 'scomplex')
+            frequency = trace_format.get_channel_frequency_ndarray(cnum)
+            data = trace_format.to_complex(trace_format.get_multiple_trace_ndarray(cnum, tnums))
+            s = data.T.reshape(-1, nports, nports)
+            write_touchstone(file, frequency, s, fmt, z0, comments=[f'channel {cnum}, traces {tnums}'])
+
+    @VNACommands.subsystem('marker')
     class Marker:
         def __init__(self, outer):
             self.outer = outer
@@ -260,108 +405,190 @@ class SiglentVNA(VISAInstrument):
         def close_all(self, cnum, tnum):
             self.outer.write(f':calculate{cnum}:measure{tnum}:marker:aoff')
 
-        def set_state(self, cnum, tnum, mnum, state: bool):
-            self.outer.write(f':calculate{cnum}:measure{tnum}:marker{mnum}:state {int(state)}')
-
-        def get_state(self, cnum, tnum, mnum):
-            return self.outer.query(f':calculate{cnum}:measure{tnum}:marker{mnum}:state?')
-
-        def set_x_value(self, cnum, tnum, mnum, value):
-            self.outer.write(f':calculate{cnum}:trace{tnum}:marker{mnum}:x {str(value)}')
-
-        def get_x_value(self, cnum=1, tnum=1, mnum=1):
-            return self.outer.query_ascii_values(f':calculate{cnum}:trace{tnum}:marker{mnum}:x?')
+        def get_x_value(self, cnum=1, tnum=1, mnum=1) -> float:
+            return self.outer.query_command(VNACommands['marker', 'x'], (cnum, tnum, mnum))
 
         def get_y_value(self, cnum=1, tnum=1, mnum=1):
             r, i = self.outer.query_ascii_values(f':calculate{cnum}:trace{tnum}:marker{mnum}:y?')
             return (r, i)
 
+        def get_y_values(self, cnum=1, tnum=1, x=()) -> numpy.ndarray:
+            """
+            Values at any number of marker frequencies from one trace fetch, interpolated on the host
+            instead of a get_y_value() round trip per marker. See analytics for peak, bandwidth and limit searches.
+            :param x: marker frequencies in Hz
+            :return: (markers, 2) array of (primary, secondary) values like get_y_value(), NaN outside the sweep
+            """
+            frequency = self.outer.format.get_channel_frequency_ndarray(cnum)
+            data = self.outer.format.get_format_data_ndarray(cnum, tnum).reshape(-1, 2)
+            return marker_values(frequency, data.T, x).T
+
+    @VNACommands.subsystem('format')
     class Format:
         def __init__(self, outer):
             self.outer = outer
+            # format the data is decoded with, sent again after a preset, see _configure()
             self.transmission_format = 'ascii'
 
         def set_trace_format(self, cnum=1, tnum=1, _type: str = 'scomplex'):
-            assert _type.lower() in TraceDataFormat
-            self.outer.write(f':calculate{cnum}:trace{tnum}:format {_type}')
+            self.outer.write_command(VNACommands['format', 'trace_format'], (cnum, tnum), _type)
 
-        def get_trace_format(self, cnum=1, tnum=1):
-            return self.outer.query(f':calculate{cnum}:trace{tnum}:format?')
+        def get_trace_format(self, cnum=1, tnum=1) -> str:
+            return self.outer.query_command(VNACommands['format', 'trace_format'], (cnum, tnum))
 
         def set_transmission_format(self, _type: str = 'ascii'):
-            assert _type.lower() in {"ascii", "real", "real32"}
-            self.transmission_format = _type
-            self.outer.write(f':format:data {_type}')
+            command = VNACommands['format', 'transmission_format']
+            self.outer.write_command(command, (), _type)
+            self.transmission_format = command.argument(_type)
 
-        def get_transmission_format(self):
-            return self.outer.query(':format:data?')
+        def _configure(self):
+            """
+            Queue the transmission format the data is decoded with, unless the settings cache shows that the
+            instrument holds it. Sent on first use and after a preset, *RST or a state load.
+            """
+            value = self.outer.cache.get(VNACommands['format', 'transmission_format'].key(()))
+            if str(value).lower() not in (self.transmission_format, short_form(self.transmission_format)):
+                self.outer.write_command(VNACommands['format', 'transmission_format'], (), self.transmission_format)
 
         def get_channel_frequency_array(self, cnum=1):
+            self._configure()
             if self.transmission_format == 'ascii':
                 return self.outer.query_ascii_values(f':sense{cnum}:frequency:data?')
             else:
-                return self.outer.query_binary_values(f':sense{cnum}:frequency:data?')
+                return self.outer.query_binary_values(f':sense{cnum}:frequency:data?', self._datatype())
 
         def get_format_data_array(self, cnum=1, tnum=1):
+            self._configure()
             if self.transmission_format == 'ascii':
                 return self.outer.query_ascii_values(f':calculate{cnum}:trace{tnum}:data:fdata?')
             else:
-                return self.outer.query_binary_values(f':calculate{cnum}:trace{tnum}:data:fdata?')
+                return self.outer.query_binary_values(f':calculate{cnum}:trace{tnum}:data:fdata?', self._datatype())
 
         # set
 
         def get_multiple_trace_data(self, cnum=1, tnums=[1]):
             query = f':calculate{cnum}:data:MFData? "{",".join(map(str, tnums))}"'
-            print(query)
+            self._configure()
             if self.transmission_format == 'ascii':
                 return self.outer.query_ascii_values(query)
             else:
-                return self.outer.query_binary_values(query)
+                return self.outer.query_binary_values(query, self._datatype())
 
-    class Scale:
-        def __init__(self, outer):
-            self.outer = outer
+        # ndarray
 
-        def set_trace_scale_auto(self, wnum, tnum):
-            self.outer.write(f':display:window{wnum}:trace{tnum}:y:scale:auto')
+        def get_channel_frequency_ndarray(self, cnum=1) -> numpy.ndarray:
+            return self._query_ndarray(f':sense{cnum}:frequency:data?')
 
-        def set_all_trace_scale_auto(self, wnum):
-            self.outer.write(f':display:window{wnum}:y:auto')
+        def get_format_data_ndarray(self, cnum=1, tnum=1) -> numpy.ndarray:
+            """
+            Formatted data of a trace as an ndarray of interleaved (primary, secondary) values.
+            Use to_complex() on a SCOMPLEX trace to get a complex view of it.
+            """
+            return self._query_ndarray(f':calculate{cnum}:trace{tnum}:data:fdata?')
 
-        def set_scale_division(self, wnum, tnum, division):
+        def get_multiple_trace_ndarray(self, cnum=1, tnums=(1,)) -> numpy.ndarray:
             """
-            Set the scale division of the trace
-            :param wnum:
-            :param tnum:
-            :param division:
-            :return:
+            Formatted data of several traces, shaped (len(tnums), points * 2).
             """
-            self.outer.write(f':display:window{wnum}:trace{tnum}:y:pdivision {division}')
+            query = f':calculate{cnum}:data:MFData? "{",".join(map(str, tnums))}"'
+            return self._query_ndarray(query).reshape(len(tnums), -1)
 
-        def get_scale_division(self, wnum, tnum):
-            return self.outer.query(f':display:window{wnum}:trace{tnum}:y:pdivision?')
+        def acquire(self, traces=None, out=None, trace_format=None) -> TraceAcquisition:
+            """
+            Every trace of several channels with one :sense:frequency:data? and one :calculate:data:mfdata?
+            transfer per channel, the trace blocks are received straight into one preallocated buffer
+            sized from the frequency axes.
+            acquisition = vna.format.acquire({1: range(1, 17)}, trace_format='scomplex'); acquisition[1, 6]
+            :param traces: {cnum: tnums}, {1: (1,)} if None
+            :param out: data of a previous acquisition, reused if its size and dtype still fit
+            :param trace_format: format of every trace, or {cnum: format}, read with one ';'-joined query
+             (or from the settings cache) if None
+            """
+            traces = {cnum: list(tnums) for cnum, tnums in (traces or {1: (1,)}).items()}
+            binary = self.transmission_format != 'ascii'
+            dtype = numpy.dtype('<' + self._datatype()) if binary else numpy.dtype(numpy.float64)
+            with self.outer._unbatched(), self.outer.lock:
+                self._configure()
+                if trace_format is None:
+                    requests = [(VNACommands['format', 'trace_format'], (cnum, tnum))
+                                for cnum, tnums in traces.items() for tnum in tnums]
+                    formats = iter(self.outer.query_commands(requests))
+                    scomplex = {cnum: all([trace_format_name(next(formats)) == 'scomplex' for _ in tnums])
+                                for cnum, tnums in traces.items()}
+                else:
+                    if isinstance(trace_format, str):
+                        trace_format = dict.fromkeys(traces, trace_format)
+                    scomplex = {cnum: trace_format_name(trace_format[cnum]) == 'scomplex' for cnum in traces}
+                axes = {cnum: self._query_ndarray(f':sense{cnum}:frequency:data?') for cnum in traces}
+                size = sum(len(axes[cnum]) * (1 + 2 * len(tnums)) for cnum, tnums in traces.items())
+                if out is not None and out.dtype == dtype and out.size == size:
+                    data = out.reshape(-1)
+                else:
+                    data = numpy.empty(size, dtype=dtype)
+                frequency, views, offset = {}, {}, 0
+                for cnum, tnums in traces.items():
+                    n = len(axes[cnum])
+                    frequency[cnum] = data[offset:offset + n]
+                    frequency[cnum][:] = axes[cnum]
+                    block = data[offset + n:offset + n * (1 + 2 * len(tnums))].reshape(len(tnums), 2 * n)
+                    offset += n * (1 + 2 * len(tnums))
+                    self._query_into(f':calculate{cnum}:data:MFData? "{",".join(map(str, tnums))}"', block, binary)
+                    views[cnum] = self.to_complex(block) if scomplex[cnum] else block
+            return TraceAcquisition(data, frequency, views, traces)
+
+        def get_trace_conversion(self, cnum=1, tnum=1, z0=50.0) -> TraceConversion:
+            """
+            Fetch a trace once as SCOMPLEX and compute every other TraceDataFormat from it on the host,
+            instead of a format switch and a full transfer per format.
+            """
+            self.set_trace_format(cnum, tnum, 'scomplex')
+            frequency = self.get_channel_frequency_ndarray(cnum)
+            return TraceConversion(frequency, self.to_complex(self.get_format_data_ndarray(cnum, tnum)), z0)
 
-        def set_scale_reference_level(self, wnum, tnum, level):
-            self.outer.write(f':display:window{wnum}:trace{tnum}:y:rlevel {level}')
+        @staticmethod
+        def to_complex(array: numpy.ndarray) -> numpy.ndarray:
+            """
+            View interleaved (real, imaginary) data as complex128 (REAL/ASCII) or complex64 (REAL32) without a copy.
+            """
+            if array.dtype.itemsize == 4:
+                return array.view(numpy.complex64)
+            return array.view(numpy.complex128)
+
+        def _datatype(self):
+            return BinaryDataType[self.transmission_format.lower()]
+
+        def _query_into(self, query, target, binary):
+            if binary:
+                length = self.outer.read_ieee_block_into(query, target)
+                if length != target.nbytes:
+                    raise ValueError(f'{query}: {length} bytes received, {target.nbytes} expected')
+            else:
+                values = self.outer.query_ascii_values(query, container=numpy.array)
+                if values.size != target.size:
+                    raise ValueError(f'{query}: {values.size} values received, {target.size} expected')
+                target.reshape(-1)[:] = values
 
-        def get_scale_reference_level(self, wnum, tnum):
-            return self.outer.query(f':display:window{wnum}:trace{tnum}:y:rlevel?')
+        def _query_ndarray(self, query):
+            self._configure()
+            if self.transmission_format == 'ascii':
+                return self.outer.query_ascii_values(query, container=numpy.array)
+            else:
+                return self.outer.query_binary_array(query, self._datatype())
 
-    class Measure:
+    @VNACommands.subsystem('scale')
+    class Scale:
         def __init__(self, outer):
             self.outer = outer
 
-        InstrumentType = {'VNA', 'SA', 'SMM'}
-
-        def set_instrument_type(self, cnum, instrument_type: str):
-            assert instrument_type.upper() in self.InstrumentType
-            self.outer.write(f':calculate{cnum}:instrument {instrument_type}')
+        def set_trace_scale_auto(self, wnum, tnum):
+            self.outer.write(f':display:window{wnum}:trace{tnum}:y:scale:auto')
 
-        def get_instrument_type(self, cnum):
-            return self.outer.query(f':calculate{cnum}:instrument?')
+        def set_all_trace_scale_auto(self, wnum):
+            self.outer.write(f':display:window{wnum}:y:auto')
 
-        def set_parameter(self, cnum, tnum, parameter):
-            self.outer.write(f':calculate{cnum}:parameter{tnum}:define {parameter}')
+    @VNACommands.subsystem('measure')
+    class Measure:
+        InstrumentType = InstrumentType
 
-        def get_parameter(self, cnum, tnum):
-            return self.outer.query(f':calculate{cnum}:parameter{tnum}:define?')
+        def __init__(self, outer):
+            self.outer = outer
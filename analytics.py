@@ -0,0 +1,212 @@
+import collections
+
+import numpy
+
+# one segment of a limit line, limits are linear between the segment ends, see limit_mask()
+LimitDType = numpy.dtype([
+    ('start', numpy.float64),  # Hz
+    ('stop', numpy.float64),  # Hz
+    ('begin', numpy.float64),  # limit at start
+    ('end', numpy.float64),  # limit at stop
+    ('upper', numpy.bool_),  # True: trace must stay below, False: above
+])
+
+# result of bandwidth(), every field shaped like the leading (trace) dimensions
+BandwidthResult = collections.namedtuple('BandwidthResult', [
+    'center', 'bandwidth', 'low', 'high', 'q', 'reference',
+])
+
+
+def as_db(trace) -> numpy.ndarray:
+    """
+    Complex traces to dB magnitude, real traces (already formatted) as they are.
+    """
+    trace = numpy.asarray(trace)
+    if numpy.iscomplexobj(trace):
+        return 20 * numpy.log10(numpy.maximum(numpy.abs(trace), 1e-300))
+    return trace
+
+
+def primary(data) -> numpy.ndarray:
+    """
+    Primary values of interleaved (primary, secondary) formatted data as returned by Format.get_*_ndarray.
+    """
+    return numpy.asarray(data)[..., 0::2]
+
+
+def marker_values(frequency, trace, x) -> numpy.ndarray:
+    """
+    Linearly interpolated trace values at the marker frequencies x, like markers set on the instrument.
+    :param frequency: shared frequency axis, ascending, (points,)
+    :param trace: (..., points), real or complex, any number of leading trace/DUT dimensions
+    :param x: marker frequencies, (markers,)
+    :return: (..., markers), NaN for markers outside the frequency range
+    """
+    frequency = numpy.asarray(frequency, dtype=numpy.float64)
+    trace = numpy.asarray(trace)
+    x = numpy.atleast_1d(numpy.asarray(x, dtype=numpy.float64))
+    right = numpy.clip(numpy.searchsorted(frequency, x), 1, len(frequency) - 1)
+    left = right - 1
+    weight = (x - frequency[left]) / (frequency[right] - frequency[left])
+    values = trace[..., left] * (1 - weight) + trace[..., right] * weight
+    outside = (x < frequency[0]) | (x > frequency[-1])
+    if outside.any():
+        values = values.astype(numpy.result_type(values.dtype, numpy.float64))
+        values[..., outside] = numpy.nan
+    return values
+
+
+def _span_mask(frequency, start, stop):
+    mask = numpy.ones(len(frequency), dtype=bool)
+    if start is not None:
+        mask &= frequency >= start
+    if stop is not None:
+        mask &= frequency <= stop
+    if not mask.any():
+        raise ValueError(f'no points between {start} and {stop} Hz')
+    return mask
+
+
+def _extremum(frequency, trace, start, stop, sign):
+    frequency = numpy.asarray(frequency, dtype=numpy.float64)
+    trace = as_db(trace)
+    masked = numpy.where(_span_mask(frequency, start, stop), trace * sign, -numpy.inf)
+    index = numpy.argmax(masked, axis=-1)
+    # parabolic refinement through the neighbours, a plain sample at the edges
+    inner = numpy.clip(index, 1, len(frequency) - 2)
+    y0, y1, y2 = (numpy.take_along_axis(masked, (inner + i)[..., None], -1)[..., 0] for i in (-1, 0, 1))
+    denominator = y0 - 2 * y1 + y2
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        offset = numpy.where((index == inner) & (denominator < 0) & numpy.isfinite(y0 + y2),
+                             0.5 * (y0 - y2) / denominator, 0.0)
+    value = numpy.take_along_axis(masked, index[..., None], -1)[..., 0]
+    x = frequency[index] + offset * (frequency[inner + 1] - frequency[inner - 1]) / 2
+    y = numpy.where(offset != 0, y1 - 0.25 * (y0 - y2) * offset, value) * sign
+    return x, y
+
+
+def peak(frequency, trace, start=None, stop=None):
+    """
+    Maximum search with parabolic interpolation between points.
+    :param trace: (..., points), complex traces are searched in dB
+    :param start: lower search limit in Hz, the whole trace if None
+    :param stop: upper search limit in Hz
+    :return: (frequency, value), each shaped like the leading dimensions of trace
+    """
+    return _extremum(frequency, trace, start, stop, 1)
+
+
+def minimum(frequency, trace, start=None, stop=None):
+    """
+    Minimum search, see peak().
+    """
+    return _extremum(frequency, trace, start, stop, -1)
+
+
+def _crossing(frequency, trace, level, index):
+    """
+    Frequency where trace crosses level between index and index + 1, linear interpolation.
+    """
+    y0 = numpy.take_along_axis(trace, index[..., None], -1)[..., 0]
+    y1 = numpy.take_along_axis(trace, (index + 1)[..., None], -1)[..., 0]
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        weight = numpy.where(y1 != y0, (level - y0) / (y1 - y0), 0.0)
+    return frequency[index] + weight * (frequency[index + 1] - frequency[index])
+
+
+def bandwidth(frequency, trace, n_db=-3.0, notch=False, start=None, stop=None) -> BandwidthResult:
+    """
+    N-dB bandwidth search around the peak (filter) or the minimum (notch), like the instrument's
+    bandwidth marker search.
+    :param trace: (..., points) in dB, complex traces are converted
+    :param n_db: level relative to the reference, below the peak of a filter or above the minimum of a notch
+     whatever its sign, e.g. -3 for both
+    :return: BandwidthResult with the center (mean of the crossings), bandwidth, crossings, Q (center / bandwidth)
+     and the reference level, NaN where the trace does not cross on both sides
+    """
+    frequency = numpy.asarray(frequency, dtype=numpy.float64)
+    trace = as_db(trace)
+    sign = -1 if notch else 1
+    mask = _span_mask(frequency, start, stop)
+    index = numpy.argmax(numpy.where(mask, trace * sign, -numpy.inf), axis=-1)
+    reference = numpy.take_along_axis(trace, index[..., None], -1)[..., 0]
+    level = reference - sign * abs(n_db)
+    # points on the far side of the level, only inside the search span
+    outside = (trace * sign < level[..., None] * sign) & mask
+    points = numpy.arange(len(frequency))
+    left = numpy.where(outside & (points < index[..., None]), points, -1).max(axis=-1)
+    right = numpy.where(outside & (points > index[..., None]), points, len(frequency)).min(axis=-1)
+    found = (left >= 0) & (right < len(frequency))
+    low = _crossing(frequency, trace, level, numpy.clip(left, 0, len(frequency) - 2))
+    high = _crossing(frequency, trace, level, numpy.clip(right - 1, 0, len(frequency) - 2))
+    low = numpy.where(found, low, numpy.nan)
+    high = numpy.where(found, high, numpy.nan)
+    width = high - low
+    center = (high + low) / 2
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        q = center / width
+    return BandwidthResult(center, width, low, high, q, reference)
+
+
+def ripple(frequency, trace, start=None, stop=None) -> numpy.ndarray:
+    """
+    Peak to peak variation of the trace between start and stop.
+    :return: shaped like the leading dimensions of trace
+    """
+    frequency = numpy.asarray(frequency, dtype=numpy.float64)
+    band = as_db(trace)[..., _span_mask(frequency, start, stop)]
+    return band.max(axis=-1) - band.min(axis=-1)
+
+
+def as_limit_line(limits) -> numpy.ndarray:
+    """
+    LimitDType array from rows of (start, stop, begin, end, upper).
+    """
+    if isinstance(limits, numpy.ndarray) and limits.dtype.names:
+        return numpy.asarray(limits, dtype=LimitDType)
+    return numpy.array([tuple(row) for row in limits], dtype=LimitDType)
+
+
+def limit_lines(frequency, limits):
+    """
+    Upper and lower limit at every point, +inf/-inf where no segment applies.
+    :return: (upper, lower), each (points,)
+    """
+    frequency = numpy.asarray(frequency, dtype=numpy.float64)
+    limits = as_limit_line(limits)
+    upper = numpy.full(len(frequency), numpy.inf)
+    lower = numpy.full(len(frequency), -numpy.inf)
+    for segment in limits:
+        inside = (frequency >= segment['start']) & (frequency <= segment['stop'])
+        span = segment['stop'] - segment['start']
+        weight = (frequency[inside] - segment['start']) / span if span else 0.0
+        value = segment['begin'] + (segment['end'] - segment['begin']) * weight
+        if segment['upper']:
+            upper[inside] = numpy.minimum(upper[inside], value)
+        else:
+            lower[inside] = numpy.maximum(lower[inside], value)
+    return upper, lower
+
+
+def limit_mask(frequency, trace, limits) -> numpy.ndarray:
+    """
+    Points failing the limit line.
+    :param trace: (..., points) in dB, complex traces are converted
+    :param limits: LimitDType array or rows of (start, stop, begin, end, upper)
+    :return: boolean (..., points), True where the trace violates a limit
+    """
+    upper, lower = limit_lines(frequency, limits)
+    trace = as_db(trace)
+    return (trace > upper) | (trace < lower)
+
+
+def limit_test(frequency, trace, limits):
+    """
+    Pass/fail of every trace against a limit line.
+    :return: (passed, margin), each shaped like the leading dimensions of trace,
+     margin being the smallest distance to a limit in dB, negative when failing
+    """
+    upper, lower = limit_lines(frequency, limits)
+    trace = as_db(trace)
+    margin = numpy.minimum(upper - trace, trace - lower).min(axis=-1)
+    return margin >= 0, margin
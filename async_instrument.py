@@ -0,0 +1,98 @@
+import asyncio
+import concurrent.futures
+import functools
+import threading
+
+# upper bound of blocking VISA calls running at the same time in the shared executor
+DEFAULT_MAX_WORKERS = 8
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor() -> concurrent.futures.ThreadPoolExecutor:
+    """
+    Executor shared by every AsyncVISAInstrument that was not given its own one.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(max_workers=DEFAULT_MAX_WORKERS,
+                                                              thread_name_prefix='visa')
+        return _executor
+
+
+def set_max_workers(max_workers: int):
+    """
+    Replace the shared executor, calls already submitted finish on the old one.
+    """
+    global _executor
+    with _executor_lock:
+        old, _executor = _executor, concurrent.futures.ThreadPoolExecutor(max_workers=max_workers,
+                                                                          thread_name_prefix='visa')
+    if old is not None:
+        old.shutdown(wait=False)
+
+
+class AsyncVISAInstrument(object):
+    """
+    asyncio facade of a VISAInstrument (or SiglentVNA / Oscilloscope).
+    The blocking pyvisa I/O runs on an executor thread while holding instrument.lock,
+    so coroutines sharing one instrument never interleave SCPI on its session.
+    """
+
+    def __init__(self, instrument, executor=None):
+        self.instrument = instrument
+        self.executor = executor
+        self._lock = None
+
+    async def run(self, function, *args, **kwargs):
+        """
+        Run function(*args, **kwargs) on the executor as one atomic exchange with the instrument.
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor or get_executor(),
+                                              functools.partial(self._locked, function, *args, **kwargs))
+
+    def _locked(self, function, *args, **kwargs):
+        with self.instrument.lock:
+            return function(*args, **kwargs)
+
+    async def do_command(self, command):
+        return await self.run(self.instrument.do_command, command)
+
+    async def do_query_string(self, query):
+        return await self.run(self.instrument.do_query_string, query)
+
+    async def do_query_number(self, query):
+        return await self.run(self.instrument.do_query_number, query)
+
+    async def write(self, command):
+        return await self.run(self.instrument.write, command)
+
+    async def query(self, command):
+        return await self.run(self.instrument.query, command)
+
+    async def query_ascii_values(self, command, container=list):
+        return await self.run(self.instrument.query_ascii_values, command, container)
+
+    async def query_binary_values(self, command, datatype='f'):
+        return await self.run(self.instrument.query_binary_values, command, datatype)
+
+    async def query_binary_array(self, command, datatype='f'):
+        return await self.run(self.instrument.query_binary_array, command, datatype)
+
+
+async def gather(instruments, function, *args, executor=None, **kwargs) -> list:
+    """
+    Run function(instrument, *args, **kwargs) on every instrument at once, e.g.
+    gather(vnas, lambda vna: vna.format.get_format_data_ndarray(1, 1))
+    :return: results in the order of instruments
+    """
+    wrappers = [instrument if isinstance(instrument, AsyncVISAInstrument) else
+                AsyncVISAInstrument(instrument, executor) for instrument in instruments]
+    return await asyncio.gather(*(wrapper.run(function, wrapper.instrument, *args, **kwargs)
+                                  for wrapper in wrappers))
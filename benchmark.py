@@ -0,0 +1,313 @@
+"""
+Driver overhead benchmarks against the simulated backends of simulation.py, no hardware needed.
+    python -m package.benchmark --latency 0.0005
+Every result reports throughput and per-iteration latency percentiles, compare runs before and after a change
+of instrument.py to catch regressions.
+"""
+import argparse
+import asyncio
+import collections
+import itertools
+import tempfile
+import time
+
+import numpy
+
+from .Oscilloscope import Oscilloscope
+from .PowerMonitor import PowerMonitor
+from .SiglentVNA import SiglentVNA
+from .async_instrument import gather
+from .metrics import MetricsCollector
+from .sink import MeasurementLog, MeasurementSink
+from .simulation import FakeSerial, SimulatedScope, SimulatedVNA, attach
+
+# one benchmark line, latencies in s, throughput in unit per s
+BenchmarkResult = collections.namedtuple('BenchmarkResult', [
+    'name', 'count', 'total', 'p50', 'p95', 'p99', 'throughput', 'unit',
+])
+
+_addresses = itertools.count()
+
+
+def run(name, function, repeat=20, work=1.0, unit='op', warmup=1) -> BenchmarkResult:
+    """
+    Time repeat calls of function().
+    :param work: units of work done by one call, e.g. points per sweep, for the throughput
+    """
+    for _ in range(warmup):
+        function()
+    latencies = numpy.empty(repeat)
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        latencies[i] = time.perf_counter() - start
+    total = latencies.sum()
+    p50, p95, p99 = numpy.percentile(latencies, (50, 95, 99))
+    return BenchmarkResult(name, repeat, total, p50, p95, p99, repeat * work / total if total else numpy.inf, unit)
+
+
+def format_results(results) -> str:
+    lines = [f'{"benchmark":<48} {"count":>6} {"total s":>9} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9} '
+             f'{"throughput":>14} unit']
+    for result in results:
+        lines.append(f'{result.name[:48]:<48} {result.count:>6} {result.total:>9.3f} {result.p50 * 1e3:>9.3f} '
+                     f'{result.p95 * 1e3:>9.3f} {result.p99 * 1e3:>9.3f} {result.throughput:>14.1f} '
+                     f'{result.unit}/s')
+    return '\n'.join(lines)
+
+
+def simulated_vna(**kwargs) -> SiglentVNA:
+    return attach(SiglentVNA(f'SIM::VNA{next(_addresses)}::INSTR'), SimulatedVNA(**kwargs))
+
+
+def simulated_scope(**kwargs) -> Oscilloscope:
+    return attach(Oscilloscope(f'SIM::SCOPE{next(_addresses)}::INSTR'), SimulatedScope(**kwargs))
+
+
+def setup_commands(channels=4) -> list:
+    """
+    Typical channel setup, 10 commands per channel.
+    """
+    commands = []
+    for cnum in range(1, channels + 1):
+        commands += [
+            f':sense{cnum}:frequency:start {1e6 * cnum:g}',
+            f':sense{cnum}:frequency:stop 3e9',
+            f':sense{cnum}:sweep:points 1601',
+            f':sense{cnum}:sweep:type linear',
+            f':sense{cnum}:sweep:time:auto 1',
+            f':source{cnum}:power -10',
+            f':sense{cnum}:average:count 4',
+            f':sense{cnum}:average:state 1',
+            f':calculate{cnum}:trace1:format scomplex',
+            f':calculate{cnum}:parameter1:define S21',
+        ]
+    return commands
+
+
+def configure_vna(vna: SiglentVNA, channels=4):
+    """
+    The same setup as setup_commands() through the subsystem setters.
+    """
+    for cnum in range(1, channels + 1):
+        vna.frequency.set_start(cnum, 1e6 * cnum)
+        vna.frequency.set_stop(cnum, 3e9)
+        vna.sweep.set_points(cnum, 1601)
+        vna.sweep.set_type(cnum, 'linear')
+        vna.sweep.set_time_auto(cnum, True)
+        vna.power.set_channel_power(cnum, -10)
+        vna.avg.set_count(cnum, 4)
+        vna.avg.set_state(cnum, True)
+        vna.format.set_trace_format(cnum, 1, 'scomplex')
+        vna.measure.set_parameter(cnum, 1, 'S21')
+
+
+def bench_configuration(latency=0.0, repeat=20) -> list:
+    """
+    Channel setup with an error check per command, one deferred check, one batched message,
+    the setters without error checks and the setters with the settings cache.
+    """
+    results = []
+    vna = simulated_vna(latency=latency)
+    commands = setup_commands()
+
+    def checked():
+        for command in commands:
+            vna.do_command(command)
+
+    def deferred():
+        with vna.deferred_error_check():
+            checked()
+
+    def batched():
+        with vna.batch():
+            checked()
+
+    results.append(run('configuration: error check per command', checked, repeat, len(commands), 'setting'))
+    results.append(run('configuration: deferred error check', deferred, repeat, len(commands), 'setting'))
+    results.append(run('configuration: batch', batched, repeat, len(commands), 'setting'))
+    results.append(run('configuration: setters', lambda: configure_vna(vna), repeat, len(commands), 'setting'))
+    vna.enable_cache()
+    results.append(run('configuration: setters, cache', lambda: configure_vna(vna), repeat, len(commands),
+                       'setting'))
+    return results
+
+
+def bench_acquisition(latency=0.0, bandwidth=None, repeat=20, points=(201, 1601, 10001)) -> list:
+    """
+    Trace fetch throughput for each transmission format, Python lists against ndarrays.
+    """
+    results = []
+    vna = simulated_vna(latency=latency, bandwidth=bandwidth)
+    vna.format.set_trace_format(1, 1, 'scomplex')
+    for n in points:
+        vna.sweep.set_points(1, n)
+        for data_format in ('ascii', 'real', 'real32'):
+            vna.format.set_transmission_format(data_format)
+            results.append(run(f'acquisition {n} points {data_format} list',
+                               lambda: vna.format.get_format_data_array(1, 1), repeat, n, 'point'))
+            results.append(run(f'acquisition {n} points {data_format} ndarray',
+                               lambda: vna.format.get_format_data_ndarray(1, 1), repeat, n, 'point'))
+    return results
+
+
+def bench_multi_trace(latency=0.0, bandwidth=None, repeat=20, points=1601, traces=16) -> list:
+    """
+    Full S-parameter capture of a 4-port with the settings cache off: a fetch per trace, one
+    :calculate:data:mfdata? with complex views, and Format.acquire() (with the frequency axis) into a reused
+    buffer, reading the trace formats or told them.
+    """
+    results = []
+    vna = simulated_vna(latency=latency, bandwidth=bandwidth)
+    vna.sweep.set_points(1, points)
+    tnums = range(1, traces + 1)
+    for tnum in tnums:
+        vna.format.set_trace_format(1, tnum, 'scomplex')
+    vna.format.set_transmission_format('real32')
+    buffer = vna.format.acquire({1: tnums}).data
+
+    def per_trace():
+        return numpy.stack([vna.format.to_complex(vna.format.get_format_data_ndarray(1, tnum)) for tnum in tnums])
+
+    name = f'{traces} traces {points} points'
+    results.append(run(f'{name} per trace', per_trace, repeat, traces * points, 'point'))
+    results.append(run(f'{name} mfdata', lambda: vna.format.to_complex(
+        vna.format.get_multiple_trace_ndarray(1, tnums)), repeat, traces * points, 'point'))
+    results.append(run(f'{name} acquire', lambda: vna.format.acquire({1: tnums}, out=buffer), repeat,
+                       traces * points, 'point'))
+    results.append(run(f'{name} acquire, formats given', lambda: vna.format.acquire(
+        {1: tnums}, out=buffer, trace_format='scomplex'), repeat, traces * points, 'point'))
+    return results
+
+
+def bench_error_check(latency=0.0, repeat=20) -> (list, str):
+    """
+    Cost of each error check policy, plus the metrics report of the per-command run.
+    """
+    results = []
+    report = ''
+    vna = simulated_vna(latency=latency)
+    commands = setup_commands()
+    collector = vna.enable_metrics(MetricsCollector())
+    for policy in ('command', 'deferred', 'off'):
+        vna.set_error_check(policy)
+
+        def configure():
+            for command in commands:
+                vna.do_command(command)
+            if policy == 'deferred':
+                vna.flush_errors()
+
+        collector.reset()
+        results.append(run(f'error check {policy}', configure, repeat, len(commands), 'setting'))
+        if policy == 'command':
+            total = sum(stats.total for stats in collector.stats().values())
+            report = f'{collector.report()}\nerror check share {collector.error_check_overhead() / total:.1%}'
+    vna.disable_metrics()
+    vna.set_error_check('command')
+    return results, report
+
+
+def bench_scaling(latency=0.001, sweep_time=0.01, repeat=10, counts=(1, 2, 4, 8), points=1601) -> list:
+    """
+    Sweep and fetch on several instruments at once with async_instrument.gather().
+    """
+    results = []
+    for count in counts:
+        vnas = [simulated_vna(latency=latency, sweep_time=sweep_time) for _ in range(count)]
+        for vna in vnas:
+            vna.sweep.set_points(1, points)
+            vna.format.set_transmission_format('real32')
+
+        def sweep(vna):
+            vna.trigger.single()
+            vna.wait_operation_complete()
+            return vna.format.get_format_data_ndarray(1, 1)
+
+        results.append(run(f'scaling {count} instruments', lambda: asyncio.run(gather(vnas, sweep)), repeat,
+                           count, 'sweep'))
+    return results
+
+
+def bench_waveform(latency=0.0, bandwidth=None, repeat=20, points=(1000, 100000)) -> list:
+    """
+    Oscilloscope capture throughput for byte and word samples.
+    """
+    results = []
+    scope = simulated_scope(latency=latency, bandwidth=bandwidth)
+    for n in points:
+        scope.waveform.set_points(n)
+        for waveform_format in ('byte', 'word'):
+            scope.waveform.set_format(waveform_format)
+            results.append(run(f'waveform {n} points {waveform_format}', lambda: scope.waveform.capture(),
+                               repeat, n, 'point'))
+    return results
+
+
+def bench_sink(repeat=1000, points=1601, chunk_rows=1024) -> list:
+    """
+    Cost of logging a sweep to a MeasurementSink in the acquisition loop, and the time range readback.
+    """
+    results = []
+    frame = numpy.zeros(points * 2, dtype=numpy.float32)
+    with tempfile.TemporaryDirectory() as path:
+        for compress in (False, True):
+            location = f'{path}/{"compressed" if compress else "plain"}'
+            timestamps = itertools.count()
+            with MeasurementSink(location, chunk_rows=chunk_rows, compress=compress) as sink:
+                results.append(run(f'sink append {points} points{", compressed" if compress else ""}',
+                                   lambda: sink.append(float(next(timestamps)), trace=frame), repeat, 1, 'sweep'))
+            log = MeasurementLog(location)
+            results.append(run(f'sink read 100 sweeps{", compressed" if compress else ""}',
+                               lambda: log.read(repeat / 2, repeat / 2 + 99), 20, 100, 'sweep'))
+    return results
+
+
+def bench_power_monitor(duration=1.0, sps=2) -> list:
+    """
+    Samples decoded per second by the reader thread at a sample rate code.
+    """
+    monitor = PowerMonitor(None, port=FakeSerial())
+    monitor.configure(2400, sps, 0)
+    monitor.start()
+    received = 0
+    latencies = []
+    start = time.perf_counter()
+    try:
+        while time.perf_counter() - start < duration:
+            begin = time.perf_counter()
+            timestamps, power = monitor.read(monitor.sample_rate // 100, timeout=0.1)
+            latencies.append(time.perf_counter() - begin)
+            received += len(power)
+    finally:
+        monitor.close()
+    total = time.perf_counter() - start
+    p50, p95, p99 = numpy.percentile(latencies, (50, 95, 99))
+    return [BenchmarkResult(f'power monitor {monitor.sample_rate} SPS', len(latencies), total, p50, p95, p99,
+                            received / total, 'sample')]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Driver overhead benchmarks against simulated instruments')
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated seconds per message')
+    parser.add_argument('--bandwidth', type=float, default=None, help='simulated bytes per second')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--metrics', action='store_true', help='print the metrics report of the error check run')
+    args = parser.parse_args(argv)
+    results = bench_configuration(args.latency, args.repeat)
+    results += bench_acquisition(args.latency, args.bandwidth, args.repeat)
+    results += bench_multi_trace(args.latency, args.bandwidth, args.repeat)
+    error_check, report = bench_error_check(args.latency, args.repeat)
+    results += error_check
+    results += bench_scaling(max(args.latency, 0.001), repeat=max(args.repeat // 2, 1))
+    results += bench_waveform(args.latency, args.bandwidth, args.repeat)
+    results += bench_sink()
+    results += bench_power_monitor()
+    print(format_results(results))
+    if args.metrics:
+        print()
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
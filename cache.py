@@ -0,0 +1,89 @@
+import threading
+
+# returned by SettingsCache.get() for a key that holds no value
+MISSING = object()
+
+
+def parse_bool(response) -> bool:
+    response = str(response).strip().lower()
+    if response in ('on', 'off'):
+        return response == 'on'
+    return bool(int(float(response)))
+
+
+def parse_int(response) -> int:
+    return int(float(response))
+
+
+def parse_str(response) -> str:
+    return str(response).strip().strip('"')
+
+
+class SettingsCache(object):
+    """
+    Values of instrument settings keyed by (subsystem, channel/trace number, parameter).
+    The cache only suppresses writes and answers getters when enabled, but it always tracks
+    invalidations so that it can be turned on at any time.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._values = {}
+        # (subsystem, index) -> keys holding a value, for invalidations with a parameter wildcard
+        self._groups = {}
+        # key -> (query, parser), used by VISAInstrument.resync_cache()
+        self._queries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            return self._values.get(key, MISSING)
+
+    def put(self, key, value, query=None, parser=None):
+        with self._lock:
+            self._values[key] = value
+            self._groups.setdefault(key[:2], set()).add(key)
+            if query is not None:
+                self._queries[key] = (query, parser)
+
+    def remember(self, key, query, parser):
+        with self._lock:
+            self._queries[key] = (query, parser)
+
+    def queries(self) -> dict:
+        with self._lock:
+            return dict(self._queries)
+
+    def invalidate(self, subsystem=None, index=None, parameter=None):
+        """
+        Drop every value matching the given key parts, None matches anything.
+        invalidate() clears the whole cache.
+        Complete keys and (subsystem, index) patterns are looked up, only other wildcards scan the cache.
+        """
+        with self._lock:
+            if subsystem is None and index is None and parameter is None:
+                self._values.clear()
+                self._groups.clear()
+                return
+            if subsystem is not None and index is not None:
+                group = self._groups.get((subsystem, index))
+                if not group:
+                    return
+                keys = [(subsystem, index, parameter)] if parameter is not None else list(group)
+            else:
+                keys = [key for key in self._values if self._match(key, subsystem, index, parameter)]
+            for key in keys:
+                if self._values.pop(key, MISSING) is not MISSING:
+                    self._discard(key)
+
+    def _discard(self, key):
+        group = self._groups[key[:2]]
+        group.discard(key)
+        if not group:
+            del self._groups[key[:2]]
+
+    @staticmethod
+    def _match(key, subsystem, index, parameter):
+        return ((subsystem is None or key[0] == subsystem) and
+                (index is None or key[1] == index) and
+                (parameter is None or key[2] == parameter))
@@ -0,0 +1,194 @@
+import numpy
+
+
+def _real(primary):
+    result = numpy.zeros(primary.shape[:-1] + (primary.shape[-1] * 2,))
+    result[..., 0::2] = primary
+    return result
+
+
+def _pair(primary, secondary):
+    result = numpy.empty(primary.shape[:-1] + (primary.shape[-1] * 2,))
+    result[..., 0::2] = primary
+    result[..., 1::2] = secondary
+    return result
+
+
+# trace format -> interleaved (primary, secondary) data as the instrument's :calculate:trace:data:fdata?
+# returns it, computed from a TraceConversion
+FormatConversions = {
+    'mlogarithmic': lambda view: _real(view.db),
+    'phase': lambda view: _real(view.phase),
+    'gdelay': lambda view: _real(view.group_delay),
+    'slinear': lambda view: _pair(view.magnitude, view.phase),
+    'slogarithmic': lambda view: _pair(view.db, view.phase),
+    'scomplex': lambda view: _pair(view.s.real, view.s.imag),
+    'smith': lambda view: _pair(view.impedance.real, view.impedance.imag),
+    'sadmittance': lambda view: _pair(view.admittance.real, view.admittance.imag),
+    'plinear': lambda view: _pair(view.magnitude, view.phase),
+    'plogarithmic': lambda view: _pair(view.db, view.phase),
+    'polar': lambda view: _pair(view.s.real, view.s.imag),
+    'mlinear': lambda view: _real(view.magnitude),
+    'swr': lambda view: _real(view.swr),
+    'real': lambda view: _real(view.s.real),
+    'imaginary': lambda view: _real(view.s.imag),
+    'uphase': lambda view: _real(numpy.degrees(view.unwrapped_phase)),
+    'pphase': lambda view: _real(numpy.mod(view.phase, 360)),
+}
+
+
+def trace_format_name(trace_format: str) -> str:
+    """
+    Long format name of a short or long SCPI form, e.g. 'MLOG' -> 'mlogarithmic'.
+    """
+    name = trace_format.strip().lower()
+    if name in FormatConversions:
+        return name
+    matches = [long_name for long_name in FormatConversions if long_name.startswith(name)]
+    if len(matches) != 1:
+        raise ValueError(f'unknown trace format {trace_format!r}')
+    return matches[0]
+
+
+class TraceConversion(object):
+    """
+    Every trace format computed on the host from one complex (SCOMPLEX) acquisition.
+    Views are computed on first access and cached, together with the intermediate magnitude and phase,
+    and returned read-only.
+    view = TraceConversion(frequency, s); view['mlog'], view['gdelay'], view.primary('swr')
+    """
+
+    def __init__(self, frequency, s, z0=50.0):
+        """
+        :param frequency: frequency axis in Hz, (points,)
+        :param s: complex trace, (..., points), leading dimensions for several traces or DUTs
+        :param z0: reference impedance of the smith and sadmittance formats in ohm
+        """
+        self.frequency = numpy.asarray(frequency, dtype=numpy.float64)
+        self.s = numpy.asarray(s, dtype=numpy.complex128)
+        self.z0 = z0
+        self._cache = {}
+
+    def __getitem__(self, trace_format) -> numpy.ndarray:
+        """
+        Interleaved (primary, secondary) data of a format, laid out like Format.get_format_data_ndarray().
+        """
+        name = trace_format_name(trace_format)
+        return self._cached(('format', name), lambda: FormatConversions[name](self))
+
+    def primary(self, trace_format) -> numpy.ndarray:
+        return self[trace_format][..., 0::2]
+
+    def secondary(self, trace_format) -> numpy.ndarray:
+        return self[trace_format][..., 1::2]
+
+    def formats(self) -> dict:
+        """
+        All formats at once, long name -> interleaved data.
+        """
+        return {name: self[name] for name in FormatConversions}
+
+    @property
+    def magnitude(self) -> numpy.ndarray:
+        return self._cached('magnitude', lambda: numpy.abs(self.s))
+
+    @property
+    def db(self) -> numpy.ndarray:
+        return self._cached('db', lambda: 20 * numpy.log10(numpy.maximum(self.magnitude, 1e-300)))
+
+    @property
+    def phase(self) -> numpy.ndarray:
+        """
+        Phase in degrees, -180 to 180.
+        """
+        return self._cached('phase', lambda: numpy.degrees(self.radians))
+
+    @property
+    def radians(self) -> numpy.ndarray:
+        return self._cached('radians', lambda: numpy.angle(self.s))
+
+    @property
+    def unwrapped_phase(self) -> numpy.ndarray:
+        """
+        Unwrapped phase in radians.
+        """
+        return self._cached('unwrapped_phase', lambda: numpy.unwrap(self.radians, axis=-1))
+
+    @property
+    def group_delay(self) -> numpy.ndarray:
+        """
+        -d(phase)/d(omega) in s, central differences over the frequency axis (one point aperture).
+        """
+        return self._cached('group_delay', lambda: -numpy.gradient(
+            self.unwrapped_phase, 2 * numpy.pi * self.frequency, axis=-1))
+
+    @property
+    def swr(self) -> numpy.ndarray:
+        def swr():
+            with numpy.errstate(divide='ignore'):
+                return numpy.where(self.magnitude < 1, (1 + self.magnitude) / (1 - self.magnitude), numpy.inf)
+
+        return self._cached('swr', swr)
+
+    @property
+    def impedance(self) -> numpy.ndarray:
+        """
+        Z0 (1 + S) / (1 - S) in ohm.
+        """
+        def impedance():
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                return self.z0 * (1 + self.s) / (1 - self.s)
+
+        return self._cached('impedance', impedance)
+
+    @property
+    def admittance(self) -> numpy.ndarray:
+        """
+        (1 - S) / (Z0 (1 + S)) in S.
+        """
+        def admittance():
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                return (1 - self.s) / (self.z0 * (1 + self.s))
+
+        return self._cached('admittance', admittance)
+
+    def _cached(self, key, compute):
+        value = self._cache.get(key)
+        if value is None:
+            value = compute()
+            value.setflags(write=False)
+            self._cache[key] = value
+        return value
+
+
+class TraceAcquisition(object):
+    """
+    Traces of several channels received into one buffer by Format.acquire(). frequency and traces hold views
+    into data, nothing is copied: traces[cnum] is (len(tnums), points) complex when every trace of the channel
+    is SCOMPLEX, otherwise (len(tnums), points * 2) interleaved (primary, secondary).
+    acquisition[1, 3] -> trace 3 of channel 1
+    """
+
+    def __init__(self, data, frequency, traces, tnums):
+        """
+        :param data: the whole buffer, channel after channel, each its frequency axis followed by its traces
+        :param frequency: {cnum: (points,)}
+        :param traces: {cnum: (len(tnums), ...)}
+        :param tnums: {cnum: list of trace numbers in the order of traces}
+        """
+        self.data = data
+        self.frequency = frequency
+        self.traces = traces
+        self.tnums = tnums
+
+    def __getitem__(self, key) -> numpy.ndarray:
+        cnum, tnum = key
+        return self.traces[cnum][self.tnums[cnum].index(tnum)]
+
+    def conversion(self, cnum, z0=50.0) -> TraceConversion:
+        """
+        Every trace format of the traces of a SCOMPLEX channel, see TraceConversion.
+        """
+        if not numpy.iscomplexobj(self.traces[cnum]):
+            raise ValueError(f'traces of channel {cnum} are not all SCOMPLEX')
+        return TraceConversion(self.frequency[cnum], self.traces[cnum], z0)
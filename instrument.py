@@ -1,81 +1,795 @@
+import concurrent.futures
+import contextlib
 import logging
-import sys
+import os
+import threading
+import time
 
-import pyvisa
+import numpy
+
+from .cache import SettingsCache, MISSING
+from .metrics import MetricsCollector, Summary, timed
+from .scpi import short_form
+from .session import session_pool, is_session_lost, service_requests
+
+# error checking policies, see VISAInstrument.error_check
+ErrorCheckPolicy = {
+    'command',  # query :system:error? after every do_* call
+    'deferred',  # remember the commands, drain the error queue in flush_errors() / check_event_status()
+    'off',  # never query the error queue
+}
+
+# *ESR? bits that indicate an entry in the error queue:
+# query error, device dependent error, execution error, command error
+ESR_ERROR_MASK = 0x04 | 0x08 | 0x10 | 0x20
+# *ESR? operation complete bit, set by *OPC once all pending operations are done
+ESR_OPERATION_COMPLETE = 0x01
+# *SRE bit requesting service when an event enabled by *ESE occurs (event status summary bit)
+SRE_EVENT_STATUS = 0x20
+
+# first and longest interval in s between *ESR? polls of wait_complete() when there are no service requests
+POLL_INTERVAL_MIN = 0.001
+POLL_INTERVAL_MAX = 0.1
+
+# commands after which every cached setting is stale, also recognized in short form and within ';'-joined messages
+ResetCommands = {'*rst', ':system:preset'}
+
+# upper bound of :system:error? queries per drain, in case an instrument never reports "no error"
+ERROR_QUEUE_MAX_DEPTH = 100
+
+# bytes per read/write of a chunked block transfer
+TRANSFER_CHUNK_SIZE = 64 * 1024
+
+
+def _header_form(header) -> str:
+    """
+    Header in lower case short form without the leading ':', e.g. ':SYSTem:PRESet' -> 'syst:pres'.
+    """
+    return ':'.join(short_form(node) for node in header.lower().lstrip(':').split(':'))
+
+
+_RESET_HEADERS = {_header_form(command) for command in ResetCommands}
+# last node of each reset header, for a cheap test before the message is parsed
+_RESET_NODES = {header.rsplit(':', 1)[-1] for header in _RESET_HEADERS}
+
+
+def is_reset(message) -> bool:
+    """
+    message holds one of ResetCommands, e.g. '*RST;*CLS' or ':SYST:PRES'.
+    """
+    lowered = message.lower()
+    if not any(node in lowered for node in _RESET_NODES):
+        return False
+    return any(_header_form(command.split()[0]) in _RESET_HEADERS for command in lowered.split(';') if command.strip())
+
+
+class InstrumentError(Exception):
+    """
+    Raised when the instrument error queue is not empty.
+    errors is a list of (error_string, commands) where commands are the commands sent since the last check,
+    any of which may have caused the error.
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__('; '.join(f'{error} (after {", ".join(commands) or "?"})' for error, commands in errors))
+
+
+class _BufferWriter(object):
+    """
+    File-like write() into a memoryview, used to receive blocks into preallocated memory.
+    """
+
+    def __init__(self, target: memoryview):
+        self.target = target
+        self.offset = 0
+
+    def write(self, data):
+        end = self.offset + len(data)
+        if end > len(self.target):
+            raise ValueError(f'block does not fit into {len(self.target)} bytes')
+        self.target[self.offset:end] = data
+        self.offset = end
+        return len(data)
 
 
 class VISAInstrument(object):
 
-    def __init__(self, visa_address, instrument_name=''):
+    def __init__(self, visa_address, instrument_name='', timeout=None, chunk_size=None, backend=None):
+        """
+        Nothing is opened here, the session is taken from session_pool on first I/O.
+        The session settings are shared by every instrument on visa_address, None keeps the current one
+        (see SessionPool.configure()).
+        :param timeout: I/O timeout of the session in ms
+        :param chunk_size: read chunk size of the session in bytes
+        :param backend: pyvisa backend, e.g. '@py'
+        """
         self.visa_address = visa_address
-        rm = pyvisa.ResourceManager()
-        rm.timeout = 5000
-        self.resource = rm.open_resource(visa_address)
+        session_pool.configure(visa_address, timeout, chunk_size, backend)
+        self.instrument_name = instrument_name
         self.logger = logging.getLogger(instrument_name)
+        self.metrics = None
+        self.error_check = 'command'
+        self._unchecked_commands = []
+        # input buffer limit of the instrument for one ';'-joined message, see batch()
+        self.max_command_length = 1024
+        self.cache = SettingsCache()
+        # serializes SCPI exchanges of different threads on this session, hold it to make a sequence atomic
+        self.lock = session_pool.lock(visa_address)
+        # per thread batch() state so that one thread's batch does not swallow other threads' commands
+        self._local = threading.local()
+        # operation complete events seen by any *ESR? read, reading clears the bit for everyone else
+        self._operation_complete = 0
+
+    @property
+    def resource(self):
+        return session_pool.get(self.visa_address)
+
+    @resource.setter
+    def resource(self, resource):
+        session_pool.register(self.visa_address, resource)
+
+    def reconnect(self):
+        session_pool.reopen(self.visa_address)
+
+    def health_check(self) -> bool:
+        return session_pool.health_check(self.visa_address)
+
+    @property
+    def _batch(self):
+        return getattr(self._local, 'batch', None)
+
+    @_batch.setter
+    def _batch(self, batch):
+        self._local.batch = batch
+
+    @property
+    def _batch_settings(self):
+        """
+        Cache updates of the settings written in the current batch, applied once the batch is sent.
+        """
+        return getattr(self._local, 'batch_settings', None)
+
+    @_batch_settings.setter
+    def _batch_settings(self, settings):
+        self._local.batch_settings = settings
 
     def do_command(self, command):
-        self.logger.info("do_command-->[%s]", command)
-        self.resource.write(command)
-        self.check_instrument_error(command)
+        self.logger.info("do_command-->[%s]", Summary(command))
+        self._write(command, check=True)
 
     def do_command_ieee_block(self, command, values):
-        self.logger.info("do_command_ieee_block-->[%s]", command)
-        self.resource.write_binary_values(f"{command} ", values, datatype='B')
-        self.check_instrument_error(command)
-
+        self.logger.info("do_command_ieee_block-->[%s]", Summary(command))
+        with self._unbatched(), self.lock:
+            self._io(command, lambda: self.resource.write_binary_values(f"{command} ", values, datatype='B'))
+            self.check_instrument_error(command)
 
     def do_query_string(self, query):
-        self.logger.info("do_query_string-->[%s]", query)
-        result = self.resource.query(query)
-        self.logger.info("result<--[%s]", result)
-        self.check_instrument_error(query)
-        return result
+        self.logger.info("do_query_string-->[%s]", Summary(query))
+        return self._query(query, lambda message: self.resource.query(message), check=True)
 
     def do_query_number(self, query):
-        self.logger.info("do_query_number-->[%s]", query)
-        result = self.resource.query(query).strip()
-        self.logger.info("result<--[%s]", result)
-        self.check_instrument_error(query)
-        return float(result)
+        self.logger.info("do_query_number-->[%s]", Summary(query))
+        return self._query(query, lambda message: self.resource.query(message), lambda result: float(result.strip()),
+                           check=True)
 
     def do_query_ieee_block(self, query):
-        self.logger.info("do_query_ieee_block-->[%s]", query)
-        result = self.resource.query_binary_values(f"{query}", datatype='s', container=bytes)
-        self.logger.info("result<--[%s]", result)
-        self.check_instrument_error(query)
-        return result
+        self.logger.info("do_query_ieee_block-->[%s]", Summary(query))
+        return self._query(query, lambda message: self.resource.query_binary_values(
+            message, datatype='s', container=bytes), check=True)
 
     def query(self, command):
-        self.logger.info("query-->[%s]", command)
-        response = self.resource.query(command).strip()
-        self.logger.info("response<--[%s]", response.strip())
-        return response
+        self.logger.info("query-->[%s]", Summary(command))
+        return self._query(command, lambda message: self.resource.query(message), str.strip)
 
     def write(self, command) -> None:
-        self.logger.info("query-->[%s]", command)
-        self.resource.write(command)
+        self.logger.info("query-->[%s]", Summary(command))
+        self._write(command)
+
+    def query_ascii_values(self, command, container=list):
+        self.logger.info("query-->[%s]", Summary(command))
+        return self._query(command, lambda message: self.resource.query_ascii_values(
+            message, converter='f', separator=',', container=container))
+
+    def query_binary_values(self, command, datatype='f'):
+        self.logger.info("query-->[%s]", Summary(command))
+        return self._query(command, lambda message: self.resource.query_binary_values(
+            message, datatype=datatype, is_big_endian=False))
+
+    def query_binary_array(self, command, datatype='f') -> numpy.ndarray:
+        """
+        Query an IEEE 488.2 binary block and decode it straight into a read-only ndarray
+        (numpy.frombuffer over the received block, no per-element Python objects).
+        :param command: query command
+        :param datatype: struct format of one element, 'f' for float32 or 'd' for float64
+        :return: 1-D ndarray
+        """
+        self.logger.info("query-->[%s]", Summary(command))
+        return self._query(command, lambda message: self.resource.query_binary_values(
+            message, datatype=datatype, is_big_endian=False, container=numpy.ndarray))
+
+    def read_ieee_block_to(self, query, file, chunk_size=TRANSFER_CHUNK_SIZE, progress=None) -> int:
+        """
+        Send query and copy the IEEE 488.2 definite length block of the response to file in chunks,
+        without holding the whole block in memory or decoding it.
+        :param file: object with a write(bytes) method
+        :param progress: called as progress(bytes done, bytes total) after every chunk
+        :return: block length in bytes
+        """
+        self.logger.info("read_ieee_block-->[%s]", Summary(query))
+        with self._unbatched(), self.lock:
+            start, begin = time.time(), time.perf_counter()
+            # the whole transfer is recorded in metrics below
+            self._io(query, lambda: self.resource.write(query), timed=False)
+            # the session _io() wrote to, reopened if the connection was lost
+            resource = self.resource
+            # skip anything before the block header
+            while resource.read_bytes(1) != b'#':
+                pass
+            digits = int(resource.read_bytes(1))
+            if not digits:
+                raise ValueError(f'indefinite length block is not supported: {query}')
+            length = int(resource.read_bytes(digits))
+            done = 0
+            error = None
+            while done < length:
+                chunk = resource.read_bytes(min(chunk_size, length - done))
+                done += len(chunk)
+                if error is not None:
+                    continue
+                try:
+                    file.write(chunk)
+                except Exception as e:
+                    # read the rest of the block anyway, it would be taken for the next response
+                    error = e
+                    continue
+                if progress is not None:
+                    progress(done, length)
+            # message terminator after the block
+            resource.read_bytes(1)
+            if error is not None:
+                raise error
+            if self.metrics is not None:
+                self.metrics.record(self.instrument_name, query, start, time.perf_counter() - begin, len(query),
+                                    length)
+        self.logger.info("response<--[%d bytes]", length)
+        return length
 
-    def query_ascii_values(self, command):
-        self.logger.info("query-->[%s]", command)
-        response = self.resource.query_ascii_values(command, converter='f', separator=',')
-        self.logger.info("response<--[%s]", response)
-        return response
+    def read_ieee_block_into(self, query, buffer, chunk_size=TRANSFER_CHUNK_SIZE, progress=None) -> int:
+        """
+        Like read_ieee_block_to(), but into a preallocated writable buffer (bytearray, ndarray, numpy.memmap).
+        :return: block length in bytes
+        """
+        writer = _BufferWriter(memoryview(buffer).cast('B'))
+        return self.read_ieee_block_to(query, writer, chunk_size, progress)
 
-    def query_binary_values(self, command):
-        self.logger.info("query-->[%s]", command)
-        response = self.resource.query_binary_values(command, datatype='f', is_big_endian=False)
-        self.logger.info("response<--[%s]", response)
-        return response
+    def write_ieee_block_from(self, command, file, size=None, chunk_size=TRANSFER_CHUNK_SIZE, progress=None) -> int:
+        """
+        Send '<command> #<n><size><data>' with data read from file in chunks, END is only sent with the last chunk.
+        :param file: object with a read(n) method
+        :param size: bytes to send, the rest of file if None (file must be seekable then)
+        :param progress: called as progress(bytes done, bytes total) after every chunk
+        :return: bytes sent
+        """
+        if size is None:
+            position = file.tell()
+            size = file.seek(0, os.SEEK_END) - position
+            file.seek(position)
+        self.logger.info("write_ieee_block-->[%s] %d bytes", Summary(command), size)
+        header = f'{command} #{len(str(size))}{size}'.encode()
+        with self._unbatched(), self.lock:
+            start, begin = time.time(), time.perf_counter()
+            send_end = self.resource.send_end
+
+            def write_header():
+                self.resource.send_end = False
+                self.resource.write_raw(header)
+
+            try:
+                self._io(command, write_header, timed=False)
+                # the session _io() wrote to, reopened if the connection was lost
+                resource = self.resource
+                done = 0
+                while done < size:
+                    chunk = file.read(min(chunk_size, size - done))
+                    if not chunk:
+                        # the instrument still waits for the rest of the block
+                        resource.clear()
+                        raise ValueError(f'file ended after {done} of {size} bytes: {command}')
+                    done += len(chunk)
+                    if done == size:
+                        resource.send_end = send_end
+                        chunk += resource.write_termination.encode()
+                    resource.write_raw(chunk)
+                    if progress is not None:
+                        progress(done, size)
+                if not size:
+                    resource.send_end = send_end
+                    resource.write_raw(resource.write_termination.encode())
+            finally:
+                self.resource.send_end = send_end
+            if self.metrics is not None:
+                self.metrics.record(self.instrument_name, command, start, time.perf_counter() - begin,
+                                    len(header) + size, 0)
+            self.check_instrument_error(command)
+        return size
+
+    def wait_operation_complete(self, timeout=None):
+        """
+        Block on *OPC? until all pending operations are complete.
+        :param timeout: seconds, the session timeout if None
+        """
+        with self._unbatched(), self.lock:
+            if timeout is None:
+                return self.query('*OPC?')
+            resource = self.resource
+            session_timeout = resource.timeout
+            resource.timeout = timeout * 1000
+            try:
+                return self.query('*OPC?')
+            finally:
+                resource.timeout = session_timeout
+
+    def wait_complete(self, command=None, timeout=None) -> float:
+        """
+        Send command followed by *OPC and wait until the instrument reports the operation complete,
+        on a service request (*ESE/*SRE) where the session supports it, otherwise by polling *ESR? with
+        exponentially growing intervals. Unlike wait_operation_complete() the session is not blocked
+        meanwhile, other threads can use it: *ESR? reads through this instrument (read_event_status(),
+        check_event_status(), another wait) pass the operation complete event on.
+        Errors reported in the event status register are checked according to error_check.
+        :param command: overlapped operation to wait for, e.g. ':trigger:single', only *OPC if None
+        :param timeout: seconds, the session timeout if None
+        :return: seconds until completion
+        """
+        with self._unbatched():
+            resource = self.resource
+            if timeout is None:
+                timeout = resource.timeout / 1000
+            message = f'{command};*OPC' if command else '*OPC'
+            if is_reset(message):
+                self.cache.invalidate()
+            enable = f'*ESE?;*SRE?;*ESE {ESR_OPERATION_COMPLETE};*SRE {SRE_EVENT_STATUS};*ESR?'
+            start = time.monotonic()
+            deadline = start + timeout
+            with service_requests(resource) as wait:
+                with self.lock:
+                    # enable the service request and clear stale events before starting the operation,
+                    # the previous enables are restored afterwards
+                    response = self._io('*ESE', lambda: self.resource.query(enable))
+                    ese, sre, status = map(int, response.strip().split(';'))
+                    self._record_event_status(status)
+                    # only events after the operation was started complete it
+                    complete = self._operation_complete
+                    try:
+                        self.logger.info("wait_complete-->[%s]", Summary(message))
+                        self._io(message, lambda: self.resource.write(message))
+                    except BaseException:
+                        self._io('*ESE', lambda: self.resource.write(f'*ESE {ese};*SRE {sre}'))
+                        raise
+                try:
+                    errors = status & ESR_ERROR_MASK
+                    interval = POLL_INTERVAL_MIN
+                    while True:
+                        remaining = deadline - time.monotonic()
+                        if wait is not None and self.resource is not resource:
+                            # the session was reopened, its events are gone with it
+                            wait = None
+                        if wait is not None:
+                            if not wait(max(remaining, 0)):
+                                raise TimeoutError(f'{message} not complete after {timeout} s')
+                            with self.lock:
+                                self._io('*STB', lambda: self.resource.read_stb())
+                        status = self.read_event_status()
+                        errors |= status & ESR_ERROR_MASK
+                        if self._operation_complete != complete:
+                            break
+                        if remaining <= 0:
+                            raise TimeoutError(f'{message} not complete after {timeout} s')
+                        if wait is None:
+                            time.sleep(min(interval, remaining))
+                            interval = min(interval * 2, POLL_INTERVAL_MAX)
+                finally:
+                    with self.lock:
+                        self._io('*ESE', lambda: self.resource.write(f'*ESE {ese};*SRE {sre}'))
+            if errors:
+                self.check_instrument_error(command or '*OPC')
+            return time.monotonic() - start
+
+    @contextlib.contextmanager
+    def batch(self, opc=False):
+        """
+        Queue the commands of the block and send them as few ';'-joined messages as possible on exit.
+        Queries inside the block return a concurrent.futures.Future that resolves when the batch is sent,
+        each query is sent together with the commands queued before it.
+        Calls that cannot be queued (block transfers, waits, error queue and multi-setting reads) send the
+        commands queued so far first and run at once, so the order of the I/O is kept.
+        Nested batch() blocks join the outermost one.
+        :param opc: wait for *OPC? after the last message
+        """
+        if self._batch is not None:
+            yield self
+            return
+        self._batch = []
+        self._batch_settings = []
+        try:
+            yield self
+        except BaseException:
+            for _, _, _, _, future in self._batch:
+                if future is not None:
+                    future.cancel()
+            self._batch = None
+            self._batch_settings = None
+            raise
+        batch, self._batch = self._batch, None
+        settings, self._batch_settings = self._batch_settings, None
+        self._send_batch(batch, opc)
+        for key, value, query, parser, invalidates in settings:
+            self._update_cache(key, value, query, parser, invalidates)
+
+    @contextlib.contextmanager
+    def _unbatched(self):
+        """
+        Send what the current batch() queued so far and run the block outside of it, for I/O that cannot be
+        queued or whose result is needed at once. The batch goes on queueing after the block.
+        """
+        batch = self._batch
+        if batch is None:
+            yield self
+            return
+        settings = self._batch_settings
+        self._batch = self._batch_settings = None
+        try:
+            self._send_batch(batch, False)
+            for key, value, query, parser, invalidates in settings:
+                self._update_cache(key, value, query, parser, invalidates)
+            yield self
+        finally:
+            self._batch, self._batch_settings = [], []
+
+    def enable_cache(self, state: bool = True):
+        """
+        Let write_setting() skip values the instrument already holds and query_setting() answer from memory.
+        """
+        if state and not self.cache.enabled:
+            self.cache.invalidate()
+        self.cache.enabled = state
+
+    def write_setting(self, key, header, argument, parser, invalidates=(), check=False):
+        """
+        Write '<header> <argument>' unless the cache already holds the same value for key.
+        :param key: (subsystem, channel/trace number, parameter)
+        :param header: command header, header + '?' reads the setting back
+        :param argument: argument text as sent to the instrument
+        :param parser: converts argument text and query responses to the cached value
+        :param invalidates: keys, or (subsystem, index, parameter) patterns with None wildcards,
+         whose values change with this setting
+        :param check: check the error queue after the command
+        """
+        self._write_setting(key, f'{header} {argument}', parser(argument), f'{header}?', parser, invalidates, check)
+
+    def write_command(self, command, index, value):
+        """
+        Set a scpi.Command, cached and invalidating according to its table entry.
+        :param index: values of the header placeholders, e.g. (cnum,)
+        """
+        argument = command.argument(value)
+        key = command.key(index)
+        if command.cacheable:
+            value = command.parser(argument)
+            if self.cache.enabled and self.cache.get(key) == value:
+                self.logger.debug("cached-->[%s %s]", command.header, argument)
+                return
+            self._write_setting(key, command.write_message(index, argument), value, command.query_message(index),
+                                command.parser, command.invalidations(key[1]), command.check)
+            return
+        message = command.write_message(index, argument)
+        self.logger.info("write_command-->[%s]", Summary(message))
+        self._write(message, command.check)
+        for pattern in command.invalidations(key[1]):
+            self.cache.invalidate(*pattern)
+
+    def query_command(self, command, index):
+        """
+        Read a scpi.Command back as its typed value, from the cache when the command is cacheable.
+        """
+        query = command.query_message(index)
+        if command.cacheable:
+            return self.query_setting(command.key(index), query, command.parser, command.check)
+        self.logger.info("query_command-->[%s]", Summary(query))
+        return self._query(query, lambda message: self.resource.query(message), command.parser, command.check)
+
+    def query_commands(self, requests) -> list:
+        """
+        Read several scpi.Commands with as few ';'-joined queries as possible, cacheable commands the cache
+        holds are answered from it.
+        :param requests: (command, index) pairs
+        :return: typed values in the order of requests
+        """
+        values = [MISSING] * len(requests)
+        if self.cache.enabled:
+            for i, (command, index) in enumerate(requests):
+                if command.cacheable:
+                    values[i] = self.cache.get(command.key(index))
+        missing = [i for i, value in enumerate(values) if value is MISSING]
+        queries = [requests[i][0].query_message(requests[i][1]) for i in missing]
+        with self._unbatched():
+            for message in self._join_commands(queries):
+                count = message.count(';') + 1
+                message_indices, missing = missing[:count], missing[count:]
+                self.logger.info("query-->[%s]", Summary(message))
+                with self.lock:
+                    responses = self._io(message, lambda: self.resource.query(message)).strip().split(';')
+                if len(responses) != count:
+                    raise ValueError(f'{len(responses)} responses to {count} queries: {message}')
+                for i, response in zip(message_indices, responses):
+                    command, index = requests[i]
+                    values[i] = command.parser(response)
+                    if command.cacheable:
+                        self.cache.put(command.key(index), values[i], command.query_message(index), command.parser)
+        return values
+
+    def _write_setting(self, key, message, value, query, parser, invalidates, check):
+        if self.cache.enabled and self.cache.get(key) == value:
+            self.logger.debug("cached-->[%s]", message)
+            return
+        self.logger.info("write_setting-->[%s]", Summary(message))
+        self._write(message, check)
+        if self._batch_settings is not None:
+            # not sent yet, nothing is known about the setting until the batch is
+            for pattern in invalidates:
+                self.cache.invalidate(*pattern)
+            self.cache.invalidate(*key)
+            self._batch_settings.append((key, value, query, parser, invalidates))
+            return
+        self._update_cache(key, value, query, parser, invalidates)
+
+    def _update_cache(self, key, value, query, parser, invalidates):
+        for pattern in invalidates:
+            self.cache.invalidate(*pattern)
+        self.cache.put(key, value, query, parser)
+
+    def query_setting(self, key, query, parser, check=False):
+        """
+        Query a setting, answered from the cache when it is enabled and holds key.
+        """
+        self.cache.remember(key, query, parser)
+        if self.cache.enabled:
+            value = self.cache.get(key)
+            if value is not MISSING:
+                if self._batch is not None:
+                    future = concurrent.futures.Future()
+                    future.set_result(value)
+                    return future
+                return value
+        self.logger.info("query-->[%s]", Summary(query))
+        result = self._query(query, lambda message: self.resource.query(message), parser, check)
+        if isinstance(result, concurrent.futures.Future):
+            result.add_done_callback(lambda f: f.cancelled() or f.exception() or self.cache.put(key, f.result()))
+        else:
+            self.cache.put(key, result)
+        return result
+
+    def resync_cache(self):
+        """
+        Re-read every setting the cache knows about, with as few ';'-joined queries as possible.
+        The cache is only replaced once every query was answered.
+        """
+        queries = self.cache.queries()
+        keys = list(queries)
+        messages = self._join_commands([queries[key][0] for key in keys])
+        values = {}
+        with self._unbatched(), self.lock:
+            for message in messages:
+                count = message.count(';') + 1
+                message_keys, keys = keys[:count], keys[count:]
+                self.logger.info("query-->[%s]", Summary(message))
+                responses = self._io(message, lambda: self.resource.query(message)).strip().split(';')
+                if len(responses) != count:
+                    self.logger.error("ERROR: %d responses to %d queries [%s]", len(responses), count, message)
+                    continue
+                for key, response in zip(message_keys, responses):
+                    values[key] = queries[key][1](response)
+            self.cache.invalidate()
+            for key, value in values.items():
+                self.cache.put(key, value)
+
+    def _write(self, command, check=False):
+        if is_reset(command):
+            self.cache.invalidate()
+        if self._batch is not None:
+            self._batch.append((command, None, None, check, None))
+            return
+        with self.lock:
+            self._io(command, lambda: self.resource.write(command))
+            if check:
+                self.check_instrument_error(command)
+
+    def _query(self, command, reader, parser=None, check=False):
+        if is_reset(command):
+            self.cache.invalidate()
+        if self._batch is not None:
+            future = concurrent.futures.Future()
+            self._batch.append((command, reader, parser, check, future))
+            return future
+        with self.lock:
+            result = self._io(command, reader, command)
+            self.logger.info("response<--[%s]", Summary(result))
+            if check:
+                self.check_instrument_error(command)
+        return parser(result) if parser else result
+
+    def enable_metrics(self, collector: MetricsCollector = None) -> MetricsCollector:
+        """
+        Record latency, bytes and call counts of every exchange, pass the same collector to several
+        instruments to get one report for all of them.
+        """
+        self.metrics = collector if collector is not None else MetricsCollector()
+        return self.metrics
+
+    def disable_metrics(self):
+        self.metrics = None
+
+    def _io(self, command, function, *args, timed=True):
+        """
+        Run one exchange with the session, reopening it and retrying once if the connection was lost.
+        :param timed: record the exchange in metrics, False if the caller records a longer transfer itself
+        """
+        try:
+            return self._timed(command, function, *args) if timed else function(*args)
+        except Exception as e:
+            if not is_session_lost(e):
+                raise
+            self.logger.error("ERROR: session lost [%s], reopening", e)
+            self.reconnect()
+            return self._timed(command, function, *args) if timed else function(*args)
+
+    def _timed(self, command, function, *args):
+        if self.metrics is None:
+            return function(*args)
+        return timed(self.metrics, self.instrument_name, command, function, *args)
+
+    def _send_batch(self, batch, opc):
+        with self.lock:
+            self._send_batch_locked(batch, opc)
+
+    def _send_batch_locked(self, batch, opc):
+        pending = []
+        checked = []
+        try:
+            for command, reader, parser, check, future in batch:
+                if check:
+                    checked.append(command)
+                if reader is None:
+                    pending.append(command)
+                    continue
+                *messages, last = self._join_commands(pending + [command])
+                for message in messages:
+                    self._timed(message, self.resource.write, message)
+                pending = []
+                result = self._timed(last, reader, last)
+                self.logger.info("response<--[%s]", Summary(result))
+                future.set_result(parser(result) if parser else result)
+            if opc:
+                pending.append('*OPC?')
+            messages = self._join_commands(pending)
+            for message in messages[:-1]:
+                self._timed(message, self.resource.write, message)
+            if opc:
+                self._timed(messages[-1], self.resource.query, messages[-1])
+            elif messages:
+                self._timed(messages[-1], self.resource.write, messages[-1])
+        except BaseException as e:
+            for _, _, _, _, future in batch:
+                if future is not None and not future.done():
+                    future.set_exception(e)
+            raise
+        if checked:
+            self.check_instrument_error('; '.join(checked))
+
+    def _join_commands(self, commands):
+        """
+        Join commands with ';' into messages no longer than max_command_length.
+        Commands are rooted with ':' so that they do not depend on the header path of the previous one.
+        """
+        messages = []
+        message = ''
+        for command in commands:
+            if not command.startswith((':', '*')):
+                command = ':' + command
+            if message and len(message) + 1 + len(command) > self.max_command_length:
+                messages.append(message)
+                message = command
+            else:
+                message = f'{message};{command}' if message else command
+        if message:
+            messages.append(message)
+        return messages
+
+    def set_error_check(self, policy: str):
+        assert policy in ErrorCheckPolicy
+        self.error_check = policy
+
+    @contextlib.contextmanager
+    def deferred_error_check(self):
+        """
+        Check the error queue once at the end of the block instead of after every command.
+        Raises InstrumentError on exit if any command in the block failed.
+        """
+        policy = self.error_check
+        self.error_check = 'deferred'
+        try:
+            yield self
+        except BaseException:
+            self.error_check = policy
+            self._unchecked_commands.clear()
+            raise
+        self.error_check = policy
+        self.flush_errors()
 
     def check_instrument_error(self, command=''):
-        # self.logger.info("check_instrument_error")
-        while True:
-            error_string = self.resource.query(':system:error?')
-            if error_string:
-                if error_string.find("+0,", 0, 3) == -1:
-                    self.logger.error("ERROR: [%s] Cmd: [%s]", error_string, command)
-                    sys.exit(1)
-                else:
+        if self.error_check == 'off':
+            return
+        if self.error_check == 'deferred':
+            self._unchecked_commands.append(command)
+            return
+        errors = self.drain_errors()
+        if errors:
+            for error in errors:
+                self.logger.error("ERROR: [%s] Cmd: [%s]", error, command)
+            raise InstrumentError([(error, [command]) for error in errors])
+
+    def drain_errors(self) -> list:
+        """
+        Read the error queue until it reports no error.
+        :return: list of error strings, empty if there was no error
+        """
+        errors = []
+        with self._unbatched():
+            for _ in range(ERROR_QUEUE_MAX_DEPTH):
+                with self.lock:
+                    error_string = self._io(':system:error?', lambda: self.resource.query(':system:error?')).strip()
+                if not error_string:
+                    self.logger.error("ERROR :system:error? returned nothing")
                     break
-            else:
-                logging.error("ERROR :system:error? returned nothing, command: %s", command)
+                if error_string.startswith(('+0,', '0,')):
+                    break
+                errors.append(error_string)
+        return errors
+
+    def flush_errors(self):
+        """
+        Drain the error queue and raise InstrumentError for the commands sent since the last check.
+        """
+        commands = self._unchecked_commands
+        self._unchecked_commands = []
+        errors = self.drain_errors()
+        if errors:
+            for error in errors:
+                self.logger.error("ERROR: [%s] Cmds: [%s]", error, '; '.join(commands))
+            raise InstrumentError([(error, commands) for error in errors])
+
+    def check_event_status(self):
+        """
+        Cheap deferred check: read *ESR? and only drain the error queue when one of the error bits is set.
+        """
+        if self.read_event_status() & ESR_ERROR_MASK:
+            self.flush_errors()
+        else:
+            self._unchecked_commands.clear()
+
+    def read_event_status(self) -> int:
+        """
+        *ESR?, reading clears the register.
+        """
+        with self._unbatched(), self.lock:
+            status = int(self._io('*ESR?', lambda: self.resource.query('*ESR?')).strip())
+            self._record_event_status(status)
+        return status
+
+    def _record_event_status(self, status):
+        """
+        Count the operation complete event of a *ESR? response for wait_complete(), call with the lock held.
+        """
+        if status & ESR_OPERATION_COMPLETE:
+            self._operation_complete += 1
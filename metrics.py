@@ -0,0 +1,217 @@
+import bisect
+import math
+import re
+import threading
+import time
+
+# upper bounds of the latency histogram buckets in seconds
+LatencyBuckets = (
+    1e-4, 2.5e-4, 5e-4,
+    1e-3, 2.5e-3, 5e-3,
+    1e-2, 2.5e-2, 5e-2,
+    0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, math.inf,
+)
+
+# headers whose time is reported as error checking overhead
+ErrorCheckHeaders = {':system:error?', '*esr?'}
+
+_SUFFIX = re.compile(r'(?<=[a-z])\d+')
+
+
+def command_header(command) -> str:
+    """
+    Header of a SCPI command without arguments and numeric suffixes,
+    ':sense1:frequency:start 1e6' -> ':sense:frequency:start'.
+    A ';'-joined message is reported under its first command.
+    """
+    command = command.split(';', 1)[0].strip().lower()
+    return _SUFFIX.sub('', command.split(' ', 1)[0])
+
+
+def payload_size(payload) -> int:
+    """
+    Size of a response in bytes, estimated for decoded containers.
+    """
+    if payload is None:
+        return 0
+    if isinstance(payload, str):
+        return len(payload)
+    nbytes = getattr(payload, 'nbytes', None)
+    if nbytes is not None:
+        return nbytes
+    try:
+        if isinstance(payload, (bytes, bytearray, memoryview)):
+            return len(payload)
+        # ascii/binary values decoded into a list or tuple of numbers
+        return len(payload) * 8
+    except TypeError:
+        return 0
+
+
+class Summary(object):
+    """
+    Lazily formatted, truncated form of a payload for log messages,
+    nothing is formatted unless the record is emitted.
+    """
+
+    def __init__(self, payload, limit=80):
+        self.payload = payload
+        self.limit = limit
+
+    def __str__(self):
+        payload = self.payload
+        shape = getattr(payload, 'shape', None)
+        if shape is not None:
+            return f'ndarray{tuple(shape)} {payload.dtype}'
+        if isinstance(payload, (list, tuple)):
+            head = ', '.join(str(value) for value in payload[:4])
+            more = ', ...' if len(payload) > 4 else ''
+            return f'{type(payload).__name__}[{len(payload)}] [{head}{more}]'
+        if isinstance(payload, (bytes, bytearray)) and len(payload) > self.limit:
+            return f'{bytes(payload[:self.limit])!r}... ({len(payload)} bytes)'
+        text = str(payload)
+        if len(text) > self.limit:
+            return f'{text[:self.limit]}... ({len(text)} chars)'
+        return text
+
+
+class CommandStats(object):
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.histogram = [0] * len(LatencyBuckets)
+
+    def add(self, elapsed, bytes_out, bytes_in, error):
+        self.count += 1
+        self.errors += error is not None
+        self.total += elapsed
+        self.min = min(self.min, elapsed)
+        self.max = max(self.max, elapsed)
+        self.bytes_out += bytes_out
+        self.bytes_in += bytes_in
+        self.histogram[bisect.bisect_left(LatencyBuckets, elapsed)] += 1
+
+    def percentile(self, q) -> float:
+        """
+        Upper bound of the bucket holding the q-th percentile (0-100), capped to the observed maximum.
+        """
+        if not self.count:
+            return math.nan
+        rank = q / 100 * self.count
+        seen = 0
+        for bound, n in zip(LatencyBuckets, self.histogram):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class MetricsCollector(object):
+    """
+    In-memory latency histograms, call counts and bytes per SCPI command header.
+    One collector can be shared by several instruments, see VISAInstrument.enable_metrics().
+    Hooks are called as hook(instrument_name, command, start, elapsed, bytes_out, bytes_in, error)
+    after every exchange, start being a time.time() timestamp.
+    """
+
+    def __init__(self):
+        self._stats = {}
+        self._lock = threading.Lock()
+        self.hooks = []
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def record(self, instrument_name, command, start, elapsed, bytes_out, bytes_in, error=None):
+        key = (instrument_name, command_header(command))
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = CommandStats()
+            stats.add(elapsed, bytes_out, bytes_in, error)
+        for hook in self.hooks:
+            hook(instrument_name, command, start, elapsed, bytes_out, bytes_in, error)
+
+    def stats(self) -> dict:
+        """
+        (instrument name, header) -> CommandStats, a snapshot copy.
+        """
+        with self._lock:
+            snapshot = {}
+            for key, stats in self._stats.items():
+                copy = CommandStats()
+                copy.__dict__.update(stats.__dict__, histogram=list(stats.histogram))
+                snapshot[key] = copy
+            return snapshot
+
+    def error_check_overhead(self) -> float:
+        """
+        Seconds spent querying the error queue and the event status register.
+        """
+        return sum(stats.total for (_, header), stats in self.stats().items() if header in ErrorCheckHeaders)
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+    def report(self) -> str:
+        """
+        Table of all headers sorted by total time.
+        """
+        rows = sorted(self.stats().items(), key=lambda item: item[1].total, reverse=True)
+        lines = [f'{"instrument":<16} {"header":<40} {"count":>7} {"total s":>9} {"mean ms":>9} {"p50 ms":>8} '
+                 f'{"p99 ms":>8} {"max ms":>8} {"out B":>10} {"in B":>12} {"errors":>6}']
+        for (name, header), stats in rows:
+            lines.append(f'{name[:16]:<16} {header[:40]:<40} {stats.count:>7} {stats.total:>9.3f} '
+                         f'{stats.total / stats.count * 1e3:>9.3f} {stats.percentile(50) * 1e3:>8.3f} '
+                         f'{stats.percentile(99) * 1e3:>8.3f} {stats.max * 1e3:>8.3f} {stats.bytes_out:>10} '
+                         f'{stats.bytes_in:>12} {stats.errors:>6}')
+        total = sum(stats.total for stats in self.stats().values())
+        lines.append(f'total {total:.3f} s, error checking {self.error_check_overhead():.3f} s')
+        return '\n'.join(lines)
+
+
+def opentelemetry_hook(tracer):
+    """
+    Hook turning every exchange into a span of an OpenTelemetry tracer,
+    e.g. collector.add_hook(opentelemetry_hook(trace.get_tracer(__name__))).
+    """
+
+    def hook(instrument_name, command, start, elapsed, bytes_out, bytes_in, error):
+        start_ns = int(start * 1e9)
+        span = tracer.start_span(command_header(command), start_time=start_ns, attributes={
+            'instrument.name': instrument_name,
+            'scpi.command': str(Summary(command)),
+            'scpi.bytes_out': bytes_out,
+            'scpi.bytes_in': bytes_in,
+        })
+        if error is not None:
+            span.record_exception(error)
+        span.end(end_time=start_ns + int(elapsed * 1e9))
+
+    return hook
+
+
+def timed(collector, instrument_name, command, function, *args):
+    """
+    Run function(*args) and record it under command.
+    """
+    start = time.time()
+    begin = time.perf_counter()
+    try:
+        result = function(*args)
+    except Exception as e:
+        collector.record(instrument_name, command, start, time.perf_counter() - begin, len(command), 0, e)
+        raise
+    collector.record(instrument_name, command, start, time.perf_counter() - begin, len(command),
+                     payload_size(result))
+    return result
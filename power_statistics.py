@@ -0,0 +1,235 @@
+import collections
+import threading
+
+import numpy
+
+PowerSnapshot = collections.namedtuple('PowerSnapshot', [
+    'count',  # samples seen
+    'mean',  # average power of all samples, dBm
+    'peak',  # dBm
+    'papr',  # peak to average power ratio, dB
+    'window_mean',  # over the last sliding window, dBm
+    'window_peak',
+    'window_papr',
+    'histogram',  # sample count per histogram bin, see PowerStatistics.bin_edges
+    'windows',  # closed tumbling windows, PowerWindowDType array
+    'bursts',  # completed bursts, PowerBurstDType array
+])
+
+PowerWindowDType = numpy.dtype([
+    ('start', numpy.float64),  # s
+    ('count', numpy.int64),
+    ('mean', numpy.float64),  # dBm
+    ('peak', numpy.float64),  # dBm
+])
+
+PowerBurstDType = numpy.dtype([
+    ('start', numpy.float64),  # s
+    ('stop', numpy.float64),  # s
+    ('count', numpy.int64),
+    ('mean', numpy.float64),  # dBm
+    ('peak', numpy.float64),  # dBm
+])
+
+
+def _dbm(milliwatt):
+    with numpy.errstate(divide='ignore'):
+        return 10 * numpy.log10(milliwatt)
+
+
+class PowerStatistics(object):
+    """
+    Online power statistics of a PowerMonitor sample stream, updated once per sample batch:
+    overall and sliding window mean/peak/PAPR, tumbling window aggregates, a fixed-bin histogram for the CCDF
+    and bursts above a power level. Memory does not grow with the number of samples.
+    The sliding window advances one batch at a time.
+    snapshot() may be called from any thread.
+    """
+
+    def __init__(self, window=1.0, tumbling=None, bin_width=0.1, power_range=(-60.0, 40.0), burst_level=None,
+                 history=1000):
+        """
+        :param window: sliding window length in s
+        :param tumbling: tumbling window length in s, no tumbling windows if None
+        :param bin_width: histogram bin width in dB
+        :param power_range: (lowest, highest) histogram power in dBm, samples outside land in the edge bins
+        :param burst_level: burst detection level in dBm, the monitor's trigger level when attached if None
+        :param history: closed tumbling windows and bursts kept for snapshots
+        """
+        self.window = window
+        self.tumbling = tumbling
+        self.bin_width = bin_width
+        self.bin_edges = numpy.arange(power_range[0], power_range[1] + bin_width, bin_width)
+        self.burst_level = burst_level
+        self.history = history
+        self._lock = threading.Lock()
+        self._monitor = None
+        self._clear()
+
+    def _clear(self):
+        self._count = 0
+        self._sum = 0.0
+        self._peak = -numpy.inf
+        self._histogram = numpy.zeros(len(self.bin_edges) - 1, dtype=numpy.int64)
+        # sliding window: (last timestamp, count, sum mW) per batch and a monotonic deque of batch maxima
+        self._batches = collections.deque()
+        self._window_count = 0
+        self._window_sum = 0.0
+        self._maxima = collections.deque()
+        # tumbling window: index and [count, sum mW, peak mW] of the open window
+        self._tumbling_origin = None
+        self._tumbling_index = None
+        self._tumbling_open = None
+        self._windows = collections.deque(maxlen=self.history)
+        # burst: [start, last timestamp, count, sum mW, peak mW] of the burst in progress
+        self._burst = None
+        self._bursts = collections.deque(maxlen=self.history)
+
+    def attach(self, monitor):
+        """
+        Update from every sample batch of a PowerMonitor.
+        """
+        if self.burst_level is None:
+            self.burst_level = monitor.trigger_level
+        monitor.add_listener(self.update)
+        self._monitor = monitor
+
+    def detach(self):
+        if self._monitor is not None:
+            self._monitor.remove_listener(self.update)
+            self._monitor = None
+
+    def update(self, timestamps, power):
+        """
+        :param timestamps: s, ascending
+        :param power: dBm
+        """
+        if not len(power):
+            return
+        power = numpy.asarray(power, dtype=numpy.float64)
+        timestamps = numpy.asarray(timestamps, dtype=numpy.float64)
+        milliwatt = 10 ** (power / 10)
+        batch_sum = float(milliwatt.sum())
+        batch_peak = float(power.max())
+        bins = numpy.clip(((power - self.bin_edges[0]) / self.bin_width).astype(numpy.int64), 0,
+                          len(self._histogram) - 1)
+        counts = numpy.bincount(bins, minlength=len(self._histogram))
+        with self._lock:
+            self._count += len(power)
+            self._sum += batch_sum
+            self._peak = max(self._peak, batch_peak)
+            self._histogram += counts
+            self._slide(timestamps[-1], len(power), batch_sum, batch_peak)
+            if self.tumbling:
+                self._tumble(timestamps, milliwatt)
+            if self.burst_level is not None:
+                self._detect_bursts(timestamps, power, milliwatt)
+
+    def _slide(self, last, count, batch_sum, batch_peak):
+        self._batches.append((last, count, batch_sum))
+        self._window_count += count
+        self._window_sum += batch_sum
+        while self._maxima and self._maxima[-1][1] <= batch_peak:
+            self._maxima.pop()
+        self._maxima.append((last, batch_peak))
+        while self._batches[0][0] <= last - self.window:
+            _, count, batch_sum = self._batches.popleft()
+            self._window_count -= count
+            self._window_sum -= batch_sum
+        while self._maxima[0][0] <= last - self.window:
+            self._maxima.popleft()
+
+    def _tumble(self, timestamps, milliwatt):
+        if self._tumbling_origin is None:
+            self._tumbling_origin = timestamps[0]
+        index = ((timestamps - self._tumbling_origin) // self.tumbling).astype(numpy.int64)
+        starts = numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(index)) + 1))
+        counts = numpy.diff(numpy.append(starts, len(index)))
+        sums = numpy.add.reduceat(milliwatt, starts)
+        peaks = numpy.maximum.reduceat(milliwatt, starts)
+        for window, count, total, peak in zip(index[starts], counts, sums, peaks):
+            if window == self._tumbling_index:
+                self._tumbling_open[0] += count
+                self._tumbling_open[1] += total
+                self._tumbling_open[2] = max(self._tumbling_open[2], peak)
+                continue
+            self._close_window()
+            self._tumbling_index = window
+            self._tumbling_open = [count, total, peak]
+
+    def _close_window(self):
+        if self._tumbling_open is None:
+            return
+        count, total, peak = self._tumbling_open
+        start = self._tumbling_origin + self._tumbling_index * self.tumbling
+        self._windows.append((start, count, _dbm(total / count), _dbm(peak)))
+
+    def _detect_bursts(self, timestamps, power, milliwatt):
+        above = power >= self.burst_level
+        starts = numpy.concatenate(([0], numpy.flatnonzero(above[1:] != above[:-1]) + 1))
+        stops = numpy.append(starts[1:], len(power))
+        sums = numpy.add.reduceat(milliwatt, starts)
+        peaks = numpy.maximum.reduceat(milliwatt, starts)
+        bursts = above[starts]
+        starts, stops, sums, peaks = starts[bursts], stops[bursts], sums[bursts], peaks[bursts]
+        if not above[0]:
+            self._close_burst()
+        elif self._burst is not None:
+            # the burst in progress continues into this batch
+            burst = self._burst
+            burst[1] = timestamps[stops[0] - 1]
+            burst[2] += stops[0]
+            burst[3] += sums[0]
+            burst[4] = max(burst[4], peaks[0])
+            starts, stops, sums, peaks = starts[1:], stops[1:], sums[1:], peaks[1:]
+            if len(starts) or not above[-1]:
+                self._close_burst()
+        if not len(starts):
+            return
+        last = above[-1]
+        if last:
+            self._burst = [timestamps[starts[-1]], timestamps[-1], stops[-1] - starts[-1], sums[-1], peaks[-1]]
+            starts, stops, sums, peaks = starts[:-1], stops[:-1], sums[:-1], peaks[:-1]
+        counts = stops - starts
+        self._bursts.extend(zip(timestamps[starts], timestamps[stops - 1], counts, _dbm(sums / counts),
+                                _dbm(peaks)))
+
+    def _close_burst(self):
+        if self._burst is None:
+            return
+        start, stop, count, total, peak = self._burst
+        self._bursts.append((start, stop, count, _dbm(total / count), _dbm(peak)))
+        self._burst = None
+
+    def snapshot(self) -> PowerSnapshot:
+        with self._lock:
+            mean = _dbm(self._sum / self._count) if self._count else numpy.nan
+            window_mean = _dbm(self._window_sum / self._window_count) if self._window_count else numpy.nan
+            window_peak = self._maxima[0][1] if self._maxima else numpy.nan
+            return PowerSnapshot(
+                count=self._count,
+                mean=mean,
+                peak=self._peak if self._count else numpy.nan,
+                papr=self._peak - mean if self._count else numpy.nan,
+                window_mean=window_mean,
+                window_peak=window_peak,
+                window_papr=window_peak - window_mean,
+                histogram=self._histogram.copy(),
+                windows=numpy.array(list(self._windows), dtype=PowerWindowDType),
+                bursts=numpy.array(list(self._bursts), dtype=PowerBurstDType),
+            )
+
+    def ccdf(self, snapshot: PowerSnapshot = None):
+        """
+        Complementary cumulative distribution of instantaneous power relative to the average power.
+        :return: (dB above average at each histogram bin edge, probability of a sample exceeding it)
+        """
+        snapshot = snapshot if snapshot is not None else self.snapshot()
+        if not snapshot.count:
+            return numpy.zeros(len(snapshot.histogram)), numpy.zeros(len(snapshot.histogram))
+        exceeding = snapshot.count - numpy.cumsum(snapshot.histogram)
+        return self.bin_edges[1:] - snapshot.mean, exceeding / snapshot.count
+
+    def reset(self):
+        with self._lock:
+            self._clear()
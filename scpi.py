@@ -0,0 +1,192 @@
+import re
+import string
+
+from .cache import MISSING, parse_str
+
+# stands for the index of the written command in Command.invalidates patterns
+INDEX = 'index'
+
+_PLACEHOLDER = re.compile(r'\{[^}]*\}')
+
+
+def short_form(mnemonic) -> str:
+    """
+    SCPI short form of a long form mnemonic: the first four letters, three if the fourth is a vowel,
+    with the numeric suffix, e.g. 'internal' -> 'int', 'segment' -> 'segm', 'real32' -> 'real32'.
+    """
+    name = mnemonic.rstrip(string.digits)
+    if len(name) > 4:
+        return (name[:3] if name[3] in 'aeiou' else name[:4]) + mnemonic[len(name):]
+    return mnemonic
+
+
+class Command(object):
+    """
+    One setting of a command table: header template, argument and response type, caching metadata.
+    The header and query templates are compiled once to positional str.format() methods.
+    """
+    __slots__ = ('subsystem', 'name', 'method', 'header', 'parser', 'values', 'fmt', 'cacheable', 'invalidates',
+                 'readable', 'writable', 'check', 'default', 'value_name', 'value_default', 'doc', 'fields',
+                 'generic_header', '_forms', '_write', '_query')
+
+    def __init__(self, subsystem, name, header, parser=parse_str, values=None, fmt=None, cacheable=True,
+                 invalidates=(), readable=True, writable=True, check=False, default=None, method=None,
+                 value_name='value', value_default=MISSING, doc=None):
+        """
+        :param subsystem: first part of the cache key and of the invalidation patterns, e.g. 'frequency'
+        :param name: parameter part of the cache key
+        :param header: command header with one {placeholder} per index, e.g. ':sense{cnum}:frequency:start'
+        :param parser: converts responses and written arguments to the typed value, e.g. float or parse_bool
+        :param values: accepted arguments as long forms in lower case, their short forms are accepted too,
+         anything if None
+        :param fmt: format spec of numeric arguments, e.g. '.2f', str() if None
+        :param cacheable: keep the value in the SettingsCache, write_setting()/query_setting() semantics
+        :param invalidates: (subsystem, index, parameter) patterns made stale by a write,
+         INDEX is replaced by the index of this command, None matches anything
+        :param check: check the error queue after the command like the do_* methods
+        :param default: value after a preset, used by the simulated backends
+        :param method: suffix of the generated get_/set_ methods, name if None
+        :param value_name: name of the value parameter of the generated setter
+        :param value_default: default of the value parameter, none if MISSING
+        :param doc: added to the docstrings of the generated methods
+        """
+        self.subsystem = subsystem
+        self.name = name
+        self.method = method or name
+        self.header = header
+        self.parser = parser
+        self.values = values
+        # long and short form -> long form
+        self._forms = {form: value for value in values for form in (value, short_form(value))} if values else {}
+        self.fmt = fmt
+        self.cacheable = cacheable
+        self.invalidates = tuple(invalidates)
+        self.readable = readable
+        self.writable = writable
+        self.check = check
+        self.default = default
+        self.value_name = value_name
+        self.value_default = value_default
+        self.doc = doc
+        self.fields = tuple(field for _, field, _, _ in string.Formatter().parse(header) if field)
+        self.generic_header = _PLACEHOLDER.sub('', header).lower()
+        assert value_name.isidentifier() and value_name not in self.fields, value_name
+        positional = header
+        for i, field in enumerate(self.fields):
+            positional = positional.replace('{%s}' % field, '{%d}' % i)
+        self._write = (positional + ' {%d}' % len(self.fields)).format
+        self._query = (positional + '?').format
+
+    def __repr__(self):
+        return f'Command({self.subsystem!r}, {self.name!r}, {self.header!r})'
+
+    def key(self, index) -> tuple:
+        """
+        SettingsCache key, (subsystem, first index or the index tuple or None, name).
+        """
+        return self.subsystem, index[0] if len(index) == 1 else (tuple(index) or None), self.name
+
+    def argument(self, value) -> str:
+        if isinstance(value, bool):
+            return str(int(value))
+        if self.values is not None:
+            assert self.accepts(value), f'{self.header}: {value!r} not in {sorted(self.values)}'
+            return self._forms[str(value).lower()]
+        if self.fmt is not None:
+            return format(value, self.fmt)
+        return str(value)
+
+    def accepts(self, value) -> bool:
+        """
+        value is one of values, or the short form of one as a getter returns it, e.g. 'INT'.
+        """
+        return str(value).lower() in self._forms
+
+    def write_message(self, index, argument) -> str:
+        return self._write(*index, argument)
+
+    def query_message(self, index) -> str:
+        return self._query(*index)
+
+    def invalidations(self, key_index) -> list:
+        """
+        :param key_index: index part of key()
+        """
+        return [(subsystem, key_index if pattern_index is INDEX else pattern_index, parameter)
+                for subsystem, pattern_index, parameter in self.invalidates]
+
+
+class CommandTable(object):
+    """
+    Commands of an instrument keyed by (subsystem, name). subsystem() generates the get_*/set_* methods
+    of a subsystem class from it, the simulated backends take their preset values from it.
+    """
+
+    def __init__(self, commands):
+        self._commands = {(command.subsystem, command.name): command for command in commands}
+
+    def __getitem__(self, key) -> Command:
+        return self._commands[key]
+
+    def __iter__(self):
+        return iter(self._commands.values())
+
+    def __len__(self):
+        return len(self._commands)
+
+    def commands(self, subsystem) -> list:
+        return [command for command in self if command.subsystem == subsystem]
+
+    def defaults(self) -> dict:
+        """
+        Header without placeholders (lower case) -> preset value, for every command with a default.
+        """
+        return {command.generic_header: command.default for command in self if command.default is not None}
+
+    def subsystem(self, name):
+        """
+        Class decorator adding get_<method>(*index) and set_<method>(*index, value) for every command of
+        subsystem name to a class with an outer instrument. Methods defined in the class body are kept.
+        """
+
+        def decorate(cls):
+            for command in self.commands(name):
+                for prefix, enabled, generate in (('get', command.readable, _getter),
+                                                  ('set', command.writable, _setter)):
+                    method = f'{prefix}_{command.method}'
+                    if enabled and method not in cls.__dict__:
+                        function = generate(command, method)
+                        function.__qualname__ = f'{cls.__qualname__}.{method}'
+                        setattr(cls, method, function)
+            return cls
+
+        return decorate
+
+
+def _compile(name, parameters, expression, command, doc):
+    """
+    Function with a real signature (names, defaults, TypeError on wrong arguments), like namedtuple's methods.
+    """
+    namespace = {}
+    exec(f'def {name}({", ".join(parameters)}):\n    return {expression}\n', {'command': command}, namespace)
+    function = namespace[name]
+    function.__doc__ = f'{doc}\n{command.doc}' if command.doc else doc
+    return function
+
+
+def _index(command) -> str:
+    return '(' + ''.join(f'{field}, ' for field in command.fields) + ')'
+
+
+def _getter(command, name):
+    return _compile(name, ('self',) + command.fields, f'self.outer.query_command(command, {_index(command)})',
+                    command, f'{command.header}? ({", ".join(command.fields)})')
+
+
+def _setter(command, name):
+    function = _compile(name, ('self',) + command.fields + (command.value_name,),
+                        f'self.outer.write_command(command, {_index(command)}, {command.value_name})',
+                        command, f'{command.header} ({", ".join(command.fields + (command.value_name,))})')
+    if command.value_default is not MISSING:
+        function.__defaults__ = (command.value_default,)
+    return function
@@ -0,0 +1,188 @@
+import contextlib
+import logging
+import threading
+
+import pyvisa
+from pyvisa.constants import EventMechanism, EventType, StatusCode
+
+# VISA errors after which the session is reopened and the I/O retried once
+SessionLostErrors = {
+    StatusCode.error_connection_lost,
+    StatusCode.error_invalid_object,
+    StatusCode.error_resource_not_found,
+    StatusCode.error_io,
+}
+
+# (timeout in ms, chunk size, backend) of an address that was never configured
+DEFAULT_SESSION_SETTINGS = (5000, None, '')
+
+_resource_managers = {}
+_resource_managers_lock = threading.Lock()
+
+
+def get_resource_manager(backend='') -> pyvisa.ResourceManager:
+    """
+    One ResourceManager per VISA backend for the whole process.
+    """
+    with _resource_managers_lock:
+        rm = _resource_managers.get(backend)
+        if rm is None:
+            rm = pyvisa.ResourceManager(backend) if backend else pyvisa.ResourceManager()
+            _resource_managers[backend] = rm
+        return rm
+
+
+def is_session_lost(error) -> bool:
+    if isinstance(error, pyvisa.errors.InvalidSession):
+        return True
+    return isinstance(error, pyvisa.errors.VisaIOError) and error.error_code in SessionLostErrors
+
+
+@contextlib.contextmanager
+def service_requests(resource):
+    """
+    Queue the service request events of resource for the block.
+    Yields wait(timeout in s) -> True on a service request, False on timeout,
+    or None when the session or the backend cannot deliver service requests.
+    """
+    try:
+        resource.enable_event(EventType.service_request, EventMechanism.queue)
+    except (AttributeError, NotImplementedError, pyvisa.errors.VisaIOError):
+        yield None
+        return
+
+    def wait(timeout):
+        try:
+            resource.wait_on_event(EventType.service_request, max(int(timeout * 1000), 1))
+            return True
+        except pyvisa.errors.VisaIOError as e:
+            if e.error_code == StatusCode.error_timeout:
+                return False
+            raise
+
+    try:
+        yield wait
+    finally:
+        try:
+            resource.disable_event(EventType.service_request, EventMechanism.queue)
+            resource.discard_events(EventType.service_request, EventMechanism.queue)
+        except pyvisa.errors.VisaIOError:
+            pass
+
+
+class SessionPool(object):
+    """
+    Open VISA sessions keyed by VISA address, shared by every instrument object using that address.
+    Sessions are opened on first use and can be reopened in place after the connection was lost.
+    """
+
+    def __init__(self):
+        self._sessions = {}
+        # address -> (timeout, chunk_size, backend) used to (re)open it
+        self._settings = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+        self.logger = logging.getLogger('SessionPool')
+
+    def configure(self, address, timeout=None, chunk_size=None, backend=None):
+        """
+        Remember how to open address, applied to an open session as well.
+        Settings left None keep their previous value, DEFAULT_SESSION_SETTINGS at first.
+        """
+        with self._lock:
+            self._settings[address] = tuple(previous if value is None else value for value, previous in
+                                            zip((timeout, chunk_size, backend),
+                                                self._settings.get(address, DEFAULT_SESSION_SETTINGS)))
+            resource = self._sessions.get(address)
+        if resource is not None:
+            self._apply(resource, timeout, chunk_size)
+
+    def lock(self, address) -> threading.RLock:
+        """
+        Lock serializing the SCPI exchanges on address, shared by all instruments using it.
+        """
+        with self._lock:
+            return self._locks.setdefault(address, threading.RLock())
+
+    def get(self, address):
+        """
+        Session of address, opened on first use.
+        """
+        resource = self._sessions.get(address)
+        if resource is not None:
+            return resource
+        with self._lock:
+            resource = self._sessions.get(address)
+            if resource is None:
+                resource = self._open(address)
+                self._sessions[address] = resource
+            return resource
+
+    def register(self, address, resource):
+        """
+        Use an already opened resource (or a stand-in with the same interface) for address.
+        """
+        with self._lock:
+            self._sessions[address] = resource
+
+    def reopen(self, address):
+        with self._lock:
+            old = self._sessions.pop(address, None)
+            if old is not None:
+                self._close(old)
+            self.logger.info("reopen-->[%s]", address)
+            resource = self._open(address)
+            self._sessions[address] = resource
+            return resource
+
+    def close(self, address):
+        with self._lock:
+            resource = self._sessions.pop(address, None)
+        if resource is not None:
+            self._close(resource)
+
+    def close_all(self):
+        with self._lock:
+            sessions, self._sessions = self._sessions, {}
+        for resource in sessions.values():
+            self._close(resource)
+
+    def is_open(self, address) -> bool:
+        return address in self._sessions
+
+    def health_check(self, address, query='*IDN?') -> bool:
+        """
+        Query address and reopen its session once if it does not answer.
+        """
+        with self.lock(address):
+            for attempt in range(2):
+                try:
+                    return bool(self.get(address).query(query).strip())
+                except (pyvisa.errors.Error, OSError) as e:
+                    self.logger.error("ERROR: health check of [%s] failed: %s", address, e)
+                    if attempt == 0:
+                        self.reopen(address)
+        return False
+
+    def _open(self, address):
+        timeout, chunk_size, backend = self._settings.get(address, DEFAULT_SESSION_SETTINGS)
+        resource = get_resource_manager(backend).open_resource(address)
+        self._apply(resource, timeout, chunk_size)
+        return resource
+
+    @staticmethod
+    def _apply(resource, timeout, chunk_size):
+        if timeout is not None:
+            resource.timeout = timeout
+        if chunk_size:
+            resource.chunk_size = chunk_size
+
+    def _close(self, resource):
+        try:
+            resource.close()
+        except Exception as e:
+            self.logger.error("ERROR: closing session failed: %s", e)
+
+
+# process wide pool used by VISAInstrument
+session_pool = SessionPool()
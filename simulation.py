@@ -0,0 +1,465 @@
+import random
+import re
+import threading
+import time
+
+import numpy
+from pyvisa import util
+
+from .Oscilloscope import ScopeCommands
+from .PowerMonitor import DATA_FRAME_HEADER, SampleRate
+from .SiglentVNA import VNACommands
+
+_NUMBERS = re.compile(r'(?<=[a-z])\d+')
+# ';' outside of double quotes
+_SEPARATOR = re.compile(r';(?=(?:[^"]*"[^"]*")*[^"]*$)')
+
+
+def ieee_block(payload: bytes) -> bytes:
+    length = str(len(payload))
+    return f'#{len(length)}{length}'.encode() + payload
+
+
+def attach(instrument, resource):
+    """
+    Let instrument (a VISAInstrument) talk to resource, e.g. attach(SiglentVNA('SIM::VNA'), SimulatedVNA()).
+    """
+    instrument.resource = resource
+    return instrument
+
+
+class SimulatedResource(object):
+    """
+    In-process stand-in for a pyvisa message based resource that understands ';'-joined SCPI messages.
+    Settings written as '<header> <value>' are stored and returned by '<header>?', subclasses add handlers
+    for everything else. Preset values and accepted arguments come from the driver's scpi.CommandTable.
+    :param latency: seconds per message written
+    :param bandwidth: bytes per second of responses, unlimited if None
+    :param error_rate: probability of queueing an execution error for a command
+    :param fail_headers: command headers (without numeric suffixes) that always queue an error
+    :param commands: scpi.CommandTable of the simulated instrument
+    """
+
+    def __init__(self, latency=0.0, bandwidth=None, error_rate=0.0, fail_headers=(), idn='SIM,INSTRUMENT,0,1.0',
+                 commands=None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.fail_headers = set(fail_headers)
+        self.idn = idn
+        self.timeout = 5000
+        self.chunk_size = 20 * 1024
+        self.send_end = True
+        self.write_termination = '\n'
+        self.read_termination = '\n'
+        self.state = {}
+        # command table entries by header without numbers
+        self.commands = {command.generic_header: command for command in commands} if commands is not None else {}
+        self.defaults = commands.defaults() if commands is not None else {}
+        self.errors = []
+        self.event_status = 0
+        self.messages = 0
+        self.status_byte = 0
+        # time at which a pending *OPC sets the operation complete bit
+        self._opc_time = None
+        self._output = bytearray()
+        self._raw = bytearray()
+        self._lock = threading.Lock()
+        self.handlers = {
+            '*idn?': lambda numbers, argument: self.idn,
+            '*opc?': lambda numbers, argument: self.operation_complete(),
+            '*opc': lambda numbers, argument: setattr(self, '_opc_time', self.busy_until()),
+            '*esr?': lambda numbers, argument: str(self.read_event_status()),
+            '*cls': lambda numbers, argument: self.clear_status(),
+            '*rst': lambda numbers, argument: self.reset(),
+            ':system:preset': lambda numbers, argument: self.reset(),
+            ':system:error?': lambda numbers, argument: self.errors.pop(0) if self.errors else '+0,"No error"',
+        }
+
+    # pyvisa interface
+
+    def write(self, message):
+        self._execute(message)
+        return len(message)
+
+    def write_raw(self, data):
+        self._raw += data
+        if self.send_end:
+            data, self._raw = bytes(self._raw), bytearray()
+            self._execute_binary(data)
+        return len(data)
+
+    def write_binary_values(self, message, values, datatype='f', is_big_endian=False):
+        payload = util.to_ieee_block(values, datatype, is_big_endian)
+        self.send_end = True
+        return self.write_raw(message.encode() + payload)
+
+    def read_bytes(self, count, break_on_termchar=False):
+        with self._lock:
+            data = bytes(self._output[:count])
+            del self._output[:count]
+        return data
+
+    def read(self):
+        with self._lock:
+            end = self._output.find(b'\n')
+            end = len(self._output) if end < 0 else end + 1
+            data = bytes(self._output[:end])
+            del self._output[:end]
+        return data.decode()
+
+    def query(self, message):
+        self.write(message)
+        return self.read()
+
+    def query_ascii_values(self, message, converter='f', separator=',', container=list):
+        values = [float(value) for value in self.query(message).strip().split(separator) if value]
+        if container in (numpy.array, numpy.ndarray):
+            return numpy.array(values)
+        return container(values)
+
+    def query_binary_values(self, message, datatype='f', is_big_endian=False, container=list, **kwargs):
+        self.write(message)
+        with self._lock:
+            block, self._output = bytes(self._output), bytearray()
+        return util.from_ieee_block(block, datatype, is_big_endian, container)
+
+    def clear(self):
+        with self._lock:
+            self._output.clear()
+            self._raw.clear()
+
+    def close(self):
+        pass
+
+    # instrument model
+
+    def reset(self):
+        self.state.clear()
+
+    def clear_status(self):
+        self.errors.clear()
+        self.event_status = 0
+
+    def read_event_status(self):
+        if self._opc_time is not None and time.time() >= self._opc_time:
+            self.event_status |= 0x01
+            self._opc_time = None
+        status, self.event_status = self.event_status, 0
+        return status
+
+    def read_stb(self):
+        return self.status_byte
+
+    def busy_until(self):
+        """
+        time.time() at which the pending overlapped operations are done.
+        """
+        return 0.0
+
+    def operation_complete(self):
+        remaining = self.busy_until() - time.time()
+        if remaining > 0:
+            time.sleep(remaining)
+        return '1'
+
+    def get(self, header, default=None):
+        return self.state.get(header, self.defaults.get(_NUMBERS.sub('', header), default))
+
+    def queue_error(self, error='-222,"Data out of range"'):
+        self.errors.append(error)
+        self.event_status |= 0x10
+
+    def data_format(self):
+        return str(self.get(':format:data', 'ascii')).lower()
+
+    def encode(self, response) -> bytes:
+        """
+        str as is, bytes as a binary block, arrays as text or binary block depending on :format:data.
+        """
+        if isinstance(response, str):
+            return response.encode()
+        if isinstance(response, (bytes, bytearray)):
+            return ieee_block(bytes(response))
+        data_format = self.data_format()
+        if data_format == 'ascii':
+            return ','.join(f'{value:.10g}' for value in numpy.ravel(response)).encode()
+        dtype = '<f4' if data_format == 'real32' else '<f8'
+        return ieee_block(numpy.ascontiguousarray(response, dtype=dtype).tobytes())
+
+    def _execute(self, message):
+        self.messages += 1
+        responses = []
+        for command in _SEPARATOR.split(message.strip()):
+            command = command.strip()
+            if not command:
+                continue
+            header, _, argument = command.partition(' ')
+            header = header.lower()
+            if not header.startswith((':', '*')):
+                header = ':' + header
+            response = self._command(header, argument.strip())
+            if response is not None:
+                responses.append(self.encode(response))
+        output = b';'.join(responses) + b'\n' if responses else b''
+        delay = self.latency + (len(output) / self.bandwidth if self.bandwidth else 0.0)
+        if delay:
+            time.sleep(delay)
+        with self._lock:
+            self._output += output
+
+    def _execute_binary(self, data):
+        start = data.index(b'#')
+        digits = int(data[start + 1:start + 2])
+        length = int(data[start + 2:start + 2 + digits])
+        payload = data[start + 2 + digits:start + 2 + digits + length]
+        self.messages += 1
+        self._command_binary(data[:start].decode().strip().rstrip(',').strip().lower(), payload)
+
+    def _command(self, header, argument):
+        generic = _NUMBERS.sub('', header)
+        numbers = [int(number) for number in _NUMBERS.findall(header)]
+        if generic in self.fail_headers or (self.error_rate and random.random() < self.error_rate):
+            self.queue_error()
+        handler = self.handlers.get(generic)
+        if handler is not None:
+            return handler(numbers, argument)
+        if header.endswith('?'):
+            return str(self.get(header[:-1], '0'))
+        if argument:
+            command = self.commands.get(generic)
+            if command is not None and command.values is not None and not command.accepts(argument):
+                self.queue_error('-224,"Illegal parameter value"')
+                return None
+            self.state[header] = argument.strip('"')
+        return None
+
+    def _command_binary(self, command, payload):
+        self.state[command] = payload
+
+
+class SimulatedVNA(SimulatedResource):
+    """
+    VNA answering the SiglentVNA commands with a synthetic resonator response on every trace.
+    :param sweep_time: seconds a triggered sweep takes, *OPC? waits for it
+    """
+
+    def __init__(self, sweep_time=0.0, **kwargs):
+        kwargs.setdefault('idn', 'SIM,VNA,0,1.0')
+        kwargs.setdefault('commands', VNACommands)
+        super().__init__(**kwargs)
+        self.sweep_time = sweep_time
+        self.files = {}
+        self._sweep_end = 0.0
+        self.defaults.update({
+            ':sense:average:complete': 1,
+            ':sense:segment:data': '5,0,1,1,1,0,0',
+        })
+        self.handlers.update({
+            ':sense:frequency:data?': lambda numbers, argument: self.frequency(numbers[0]),
+            ':calculate:trace:data:fdata?': lambda numbers, argument: self.fdata(numbers[0], numbers[1]),
+            ':calculate:data:mfdata?': lambda numbers, argument: numpy.concatenate([
+                self.fdata(numbers[0], int(tnum)) for tnum in argument.strip('"').split(',')]),
+            ':calculate:trace:marker:x?': lambda numbers, argument: '1e9',
+            ':calculate:trace:marker:y?': lambda numbers, argument: '-3.0,0',
+            ':sense:segment:data?': lambda numbers, argument: numpy.array(
+                str(self.get(f':sense{numbers[0]}:segment:data')).split(','), dtype=numpy.float64),
+            ':trigger:single': lambda numbers, argument: self.trigger(),
+            ':mmemory:transfer?': lambda numbers, argument: self.files.get(argument.strip('"'), b''),
+        })
+
+    def points(self, cnum):
+        return int(float(self.get(f':sense{cnum}:sweep:points')))
+
+    def frequency(self, cnum):
+        return numpy.linspace(float(self.get(f':sense{cnum}:frequency:start')),
+                              float(self.get(f':sense{cnum}:frequency:stop')), self.points(cnum))
+
+    def s_parameter(self, cnum, tnum):
+        frequency = self.frequency(cnum)
+        center = frequency[len(frequency) // 2] * (1 + 0.01 * tnum)
+        q = 50.0
+        return 1 / (1 + 2j * q * (frequency - center) / center) * numpy.exp(-2j * numpy.pi * frequency * 1e-9)
+
+    def fdata(self, cnum, tnum):
+        """
+        Interleaved (primary, secondary) values, re/im for SCOMPLEX and dB/0 for every other format.
+        """
+        s = self.s_parameter(cnum, tnum)
+        data = numpy.zeros(2 * len(s))
+        trace_format = str(self.get(f':calculate{cnum}:trace{tnum}:format')).lower()
+        if trace_format.startswith('scom'):
+            data[0::2], data[1::2] = s.real, s.imag
+        else:
+            data[0::2] = 20 * numpy.log10(numpy.abs(s))
+        return data
+
+    def trigger(self):
+        """
+        One sweep, or a full average with trigger averaging on.
+        """
+        sweeps = 1
+        if str(self.get(':trigger:average', 0)).lower() in ('1', 'on') and \
+                str(self.get(':sense1:average:state')).lower() in ('1', 'on'):
+            sweeps = int(float(self.get(':sense1:average:count')))
+        self._sweep_end = time.time() + self.sweep_time * sweeps
+
+    def busy_until(self):
+        return self._sweep_end
+
+    def _command_binary(self, command, payload):
+        if command.startswith(':mmemory:transfer'):
+            self.files[command.partition(' ')[2].strip().strip('"')] = payload
+        else:
+            super()._command_binary(command, payload)
+
+
+class SimulatedScope(SimulatedResource):
+    """
+    Oscilloscope answering the Oscilloscope commands with a noisy 1 MHz sine on every channel.
+    :param acquisition_time: seconds a :digitize takes
+    :param max_points: record length of 'max' points
+    """
+
+    def __init__(self, acquisition_time=0.0, max_points=1000000, **kwargs):
+        kwargs.setdefault('idn', 'SIM,SCOPE,0,1.0')
+        kwargs.setdefault('commands', ScopeCommands)
+        super().__init__(**kwargs)
+        self.acquisition_time = acquisition_time
+        self.max_points = max_points
+        self.measurements = []
+        self._acquisition_end = 0.0
+        self.defaults.update({
+            ':waveform:format': 'byte',
+            ':waveform:points': 1000,
+            ':waveform:source': 'channel1',
+            ':acquire:segmented:count': 1,
+            ':acquire:segmented:index': 1,
+        })
+        self.handlers.update({
+            ':digitize': lambda numbers, argument: setattr(self, '_acquisition_end',
+                                                          time.time() + self.acquisition_time),
+            ':waveform:preamble?': lambda numbers, argument: self.preamble(),
+            ':waveform:data?': lambda numbers, argument: self.data(),
+            ':waveform:segmented:count?': lambda numbers, argument: str(self.get(':acquire:segmented:count')),
+            ':waveform:segmented:ttag?': lambda numbers, argument: str(
+                (int(self.get(':acquire:segmented:index')) - 1) * 1e-3),
+            ':measure:clear': lambda numbers, argument: self.measurements.clear(),
+            ':measure:results?': lambda numbers, argument: self.results(),
+        })
+        for name in ('vrms', 'vmax', 'vmin', 'frequency'):
+            self.handlers[f':measure:{name}'] = lambda numbers, argument, name=name: self.measurements.append(
+                (name, argument.split(',')[-1]))
+
+    def busy_until(self):
+        return self._acquisition_end
+
+    def _command(self, header, argument):
+        # :digitize holds off everything but status reporting until the acquisition is done
+        if header not in ('*opc', '*esr?', '*stb?'):
+            remaining = self._acquisition_end - time.time()
+            if remaining > 0:
+                time.sleep(remaining)
+        return super()._command(header, argument)
+
+    def record(self):
+        points = str(self.get(':waveform:points')).lower()
+        points = self.max_points if points == 'max' else int(float(points))
+        word = str(self.get(':waveform:format')).lower() == 'word'
+        return points, word
+
+    def preamble(self):
+        points, word = self.record()
+        xincrement = float(self.get(':timebase:scale')) * 10 / points
+        yincrement = float(self.get(':channel1:scale')) * 8 / (65536 if word else 256)
+        return f'{int(word)},0,{points},1,{xincrement:g},{-points / 2 * xincrement:g},0,{yincrement:g},0,0'
+
+    def data(self):
+        points, word = self.record()
+        time_axis = numpy.arange(points) * float(self.get(':timebase:scale')) * 10 / points
+        wave = numpy.sin(2 * numpy.pi * 1e6 * time_axis) * 0.8 + numpy.random.randn(points) * 0.01
+        full_scale = 32767 if word else 127
+        return (wave * full_scale).astype('<i2' if word else 'i1').tobytes()
+
+    def results(self):
+        values = []
+        labeled = str(self.get(':measure:statistics')).lower() == 'on'
+        for name, argument in self.measurements:
+            value = 1e6 if name == 'frequency' else 0.8
+            values += [f'{name}({argument})', f'{value:g}', f'{value:g}', f'{value:g}', f'{value:g}', '0', '1'] \
+                if labeled else [f'{value:g}']
+        return ','.join(values)
+
+
+class FakeSerial(object):
+    """
+    Stand-in for serial.Serial producing PowerMonitor data frames in real time at the configured sample rate.
+    :param power: function of time in s returning power in dBm for an array of sample times
+    :param corrupt_rate: probability of flipping a byte, to exercise resynchronization
+    """
+
+    def __init__(self, power=None, sample_rate=1000, corrupt_rate=0.0, timeout=0.02):
+        self.power = power if power is not None else (
+            lambda t: numpy.where(t % 1.0 < 0.2, 10.0, -20.0) + numpy.random.randn(len(t)) * 0.1)
+        self.sample_rate = sample_rate
+        self.corrupt_rate = corrupt_rate
+        self.timeout = timeout
+        self.written = []
+        self.is_open = True
+        self._start = time.time()
+        self._generated = 0
+        self._buffer = bytearray()
+
+    def write(self, data):
+        data = bytes(data)
+        self.written.append(data)
+        if data[:3] == bytes([0x10, 0x08, 0x01]):
+            self.sample_rate = SampleRate[data[5]]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def reset_input_buffer(self):
+        self._generate()
+        self._buffer.clear()
+
+    @property
+    def in_waiting(self):
+        self._generate()
+        return len(self._buffer)
+
+    def read(self, size=1):
+        deadline = time.time() + (self.timeout or 0)
+        while True:
+            self._generate()
+            if len(self._buffer) >= size or time.time() >= deadline:
+                break
+            time.sleep(min(0.001, self.timeout or 0))
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def close(self):
+        self.is_open = False
+
+    def _generate(self):
+        due = int((time.time() - self._start) * self.sample_rate)
+        count = due - self._generated
+        if count <= 0:
+            return
+        t = self._start + (self._generated + numpy.arange(count)) / self.sample_rate
+        power = numpy.round(numpy.clip(self.power(t), -127, 127), 2)
+        magnitude = numpy.round(numpy.abs(power) * 100).astype(numpy.int64)
+        frames = numpy.empty((count, 6), dtype=numpy.uint8)
+        frames[:, :3] = numpy.frombuffer(DATA_FRAME_HEADER, dtype=numpy.uint8)
+        frames[:, 3] = (magnitude // 100) | numpy.where(power < 0, 0x80, 0)
+        frames[:, 4] = magnitude % 100
+        frames[:, 5] = (frames[:, 2].astype(numpy.uint16) + frames[:, 3] + frames[:, 4]) & 0xFF
+        data = frames.tobytes()
+        if self.corrupt_rate:
+            data = bytearray(data)
+            for i in numpy.flatnonzero(numpy.random.random(len(data)) < self.corrupt_rate):
+                data[i] ^= 0xFF
+        self._buffer += data
+        self._generated = due
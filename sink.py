@@ -0,0 +1,417 @@
+import collections
+import json
+import os
+import shutil
+import threading
+
+import numpy
+
+from .stream import OverflowPolicy
+
+MANIFEST = 'manifest.json'
+# column every sink has, s since the epoch, ascending
+TIMESTAMP = 'timestamp'
+
+_PARTIAL = '.partial'
+_COMPRESSED = '.npz'
+
+
+def _chunk_name(index) -> str:
+    return f'chunk-{index:06d}'
+
+
+def _chunk_index(name) -> int:
+    return int(name[len('chunk-'):len('chunk-') + 6])
+
+
+def _valid_rows(timestamps) -> int:
+    """
+    Rows of an open chunk, whose timestamps are NaN until written.
+    """
+    missing = numpy.isnan(timestamps)
+    return int(numpy.argmax(missing)) if missing.any() else len(timestamps)
+
+
+def _write_synced(path, write):
+    with open(path, 'wb') as file:
+        write(file)
+        file.flush()
+        os.fsync(file.fileno())
+
+
+def _replace_atomic(path, write):
+    """
+    Write path through a temporary file, so that readers and a restart after a crash see the old or the new file.
+    """
+    _write_synced(path + '.tmp', write)
+    os.replace(path + '.tmp', path)
+
+
+def _chunk_names(path) -> list:
+    """
+    Chunks in path, sealed and open, without the open chunk left behind by a crash during sealing.
+    """
+    names = sorted(name for name in os.listdir(path) if name.startswith('chunk-') and not name.endswith('.tmp'))
+    sealed = {_chunk_index(name) for name in names if not name.endswith(_PARTIAL)}
+    return [name for name in names if not (name.endswith(_PARTIAL) and _chunk_index(name) in sealed)]
+
+
+def _read_manifest(path) -> dict:
+    with open(os.path.join(path, MANIFEST)) as file:
+        return json.load(file)
+
+
+def _columns(manifest) -> dict:
+    return {name: (numpy.dtype(dtype), tuple(shape)) for name, (dtype, shape) in manifest['columns'].items()}
+
+
+def _load_chunk(path, name) -> dict:
+    """
+    Columns of a chunk, memory-mapped unless the chunk is compressed.
+    """
+    location = os.path.join(path, name)
+    if name.endswith(_COMPRESSED):
+        with numpy.load(location) as archive:
+            return {column: archive[column] for column in archive.files}
+    data = {file[:-len('.npy')]: numpy.load(os.path.join(location, file), mmap_mode='r')
+            for file in os.listdir(location) if file.endswith('.npy')}
+    if name.endswith(_PARTIAL):
+        if TIMESTAMP not in data:
+            # still being created, the timestamp column comes last
+            return {}
+        rows = _valid_rows(data[TIMESTAMP])
+        data = {column: array[:rows] for column, array in data.items()}
+    return data
+
+
+def _chunk_entry(name, timestamps, compressed) -> dict:
+    return {'name': name, 'rows': len(timestamps), 'start': float(timestamps[0]) if len(timestamps) else None,
+            'stop': float(timestamps[-1]) if len(timestamps) else None, 'compressed': compressed}
+
+
+class MeasurementSink(object):
+    """
+    Append-only columnar measurement log in a directory, for acquisitions running for days.
+    Every chunk holds chunk_rows rows, one .npy file per column, manifest.json lists the sealed chunks
+    with their time range. append() only copies the batch into a queue, a writer thread writes the queued
+    batches into the memory-mapped files of the open chunk.
+    A chunk is written as chunk-N.partial and renamed when full, the manifest is replaced atomically:
+    after a crash the written rows of the open chunk are sealed when the directory is opened again.
+    Read it back with MeasurementLog, also while the sink is writing.
+    with MeasurementSink('soak') as sink: sink.append(timestamp, trace=data)
+    """
+
+    def __init__(self, path, columns=None, chunk_rows=1 << 16, compress=False, queue_size=256, policy='block'):
+        """
+        :param path: directory, created if missing, appended to if it holds a sink already
+        :param columns: {name: dtype or (dtype, shape of one row)}, taken from the first append() if None
+        :param chunk_rows: rows per chunk file
+        :param compress: seal chunks as compressed .npz, read back into memory instead of memory-mapped
+        :param queue_size: batches queued for the writer thread
+        :param policy: 'block' or 'drop_oldest' when the queue is full, see OverflowPolicy
+        """
+        assert policy in OverflowPolicy
+        self.path = path
+        self.chunk_rows = chunk_rows
+        self.compress = compress
+        self.queue_size = queue_size
+        self.policy = policy
+        self.columns = None
+        self.chunks = []
+        self.dropped = 0
+        self._index = 0
+        self._arrays = None
+        self._rows = 0
+        self._queue = collections.deque()
+        self._pending = 0
+        self._closed = False
+        self._error = None
+        self._monitor = None
+        self._condition = threading.Condition()
+        os.makedirs(path, exist_ok=True)
+        if os.path.exists(os.path.join(path, MANIFEST)):
+            manifest = _read_manifest(path)
+            self.columns = _columns(manifest)
+            self.chunk_rows = manifest['chunk_rows']
+            self.chunks = manifest['chunks']
+            self._recover()
+        elif columns is not None:
+            self._set_columns({name: column if isinstance(column, tuple) else (column, ())
+                               for name, column in columns.items()})
+        self._thread = threading.Thread(target=self._run, name=f'MeasurementSink-{os.path.basename(path)}',
+                                        daemon=True)
+        self._thread.start()
+
+    def append(self, timestamps, **columns):
+        """
+        Queue rows for the writer thread, the arrays are copied and may be reused by the caller at once.
+        :param timestamps: s, ascending, a scalar for a single row
+        :param columns: one array per column, (rows, ...) or the shape of one row for a single row
+        """
+        if numpy.ndim(timestamps) == 0:
+            timestamps = [timestamps]
+            columns = {name: numpy.asarray(value)[None] for name, value in columns.items()}
+        timestamps = numpy.array(timestamps, dtype=numpy.float64)
+        columns = {name: numpy.array(value) for name, value in columns.items()}
+        with self._condition:
+            if self._error is not None:
+                raise self._error
+            if self._closed:
+                raise ValueError('measurement sink is closed')
+            if self.columns is None:
+                self._set_columns({name: (value.dtype, value.shape[1:]) for name, value in columns.items()})
+            if set(columns) != set(self.columns) - {TIMESTAMP}:
+                raise ValueError(f'columns {sorted(columns)} do not match {sorted(set(self.columns) - {TIMESTAMP})}')
+            for name, value in columns.items():
+                if len(value) != len(timestamps) or value.shape[1:] != self.columns[name][1]:
+                    raise ValueError(f'column {name} shaped {value.shape}, expected '
+                                     f'{(len(timestamps),) + self.columns[name][1]}')
+            while len(self._queue) >= self.queue_size:
+                if self.policy == 'drop_oldest':
+                    self.dropped += len(self._queue.popleft()[0])
+                    self._pending -= 1
+                    break
+                # a failed writer never drains the queue
+                self._condition.wait_for(lambda: len(self._queue) < self.queue_size or self._error is not None
+                                         or self._closed)
+                if self._error is not None:
+                    raise self._error
+                if self._closed:
+                    raise ValueError('measurement sink is closed')
+            self._queue.append((timestamps, columns))
+            self._pending += 1
+            self._condition.notify_all()
+
+    def flush(self, timeout=None):
+        """
+        Wait until every queued batch is written.
+        """
+        with self._condition:
+            if not self._condition.wait_for(lambda: not self._pending or self._error is not None, timeout):
+                raise TimeoutError('measurement sink queue not written')
+            if self._error is not None:
+                raise self._error
+
+    def close(self):
+        """
+        Write the queued batches, seal the open chunk and stop the writer thread.
+        """
+        self.detach()
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def attach(self, monitor):
+        """
+        Log every sample batch of a PowerMonitor in a power column.
+        """
+        monitor.add_listener(self._log_power)
+        self._monitor = monitor
+
+    def detach(self):
+        if self._monitor is not None:
+            self._monitor.remove_listener(self._log_power)
+            self._monitor = None
+
+    def _log_power(self, timestamps, power):
+        self.append(timestamps, power=power)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _set_columns(self, columns):
+        self.columns = {TIMESTAMP: (numpy.dtype(numpy.float64), ())}
+        self.columns.update({name: (numpy.dtype(dtype), tuple(shape)) for name, (dtype, shape) in columns.items()})
+        self._write_manifest()
+
+    def _write_manifest(self):
+        manifest = {
+            'columns': {name: [dtype.str, list(shape)] for name, (dtype, shape) in self.columns.items()},
+            'chunk_rows': self.chunk_rows,
+            'chunks': self.chunks,
+        }
+        _replace_atomic(os.path.join(self.path, MANIFEST), lambda file: file.write(json.dumps(manifest).encode()))
+
+    def _recover(self):
+        """
+        Seal the open chunk of a crashed writer and add chunks sealed but missing in the manifest.
+        """
+        listed = {chunk['name'] for chunk in self.chunks}
+        names = _chunk_names(self.path)
+        for name in names:
+            if name.endswith(_PARTIAL):
+                rows = len(_load_chunk(self.path, name).get(TIMESTAMP, ()))
+                if rows:
+                    self._index = _chunk_index(name)
+                    self._seal(rows)
+                else:
+                    shutil.rmtree(os.path.join(self.path, name))
+            elif name not in listed:
+                self.chunks.append(_chunk_entry(name, _load_chunk(self.path, name)[TIMESTAMP],
+                                                name.endswith(_COMPRESSED)))
+        # compressed before the crash, only the removal of the open chunk is missing
+        for name in os.listdir(self.path):
+            if name.endswith(_PARTIAL) and name not in names:
+                shutil.rmtree(os.path.join(self.path, name))
+        self.chunks.sort(key=lambda chunk: chunk['name'])
+        self._index = max((_chunk_index(name) + 1 for name in os.listdir(self.path) if name.startswith('chunk-')),
+                          default=0)
+        self._write_manifest()
+
+    def _open_chunk(self):
+        location = os.path.join(self.path, _chunk_name(self._index) + _PARTIAL)
+        os.makedirs(location, exist_ok=True)
+        self._arrays = {name: numpy.lib.format.open_memmap(os.path.join(location, name + '.npy'), mode='w+',
+                                                           dtype=dtype, shape=(self.chunk_rows,) + shape)
+                        for name, (dtype, shape) in self.columns.items() if name != TIMESTAMP}
+        # readers take the rows before the first NaN timestamp, the file only appears filled with NaN
+        _replace_atomic(os.path.join(location, TIMESTAMP + '.npy'), lambda file: numpy.save(
+            file, numpy.full(self.chunk_rows, numpy.nan)))
+        self._arrays[TIMESTAMP] = numpy.load(os.path.join(location, TIMESTAMP + '.npy'), mmap_mode='r+')
+        self._rows = 0
+
+    def _seal(self, rows):
+        """
+        Truncate the open chunk to rows, rename or compress it and list it in the manifest.
+        """
+        name = _chunk_name(self._index)
+        partial = os.path.join(self.path, name + _PARTIAL)
+        self._arrays = None
+        data = {column: numpy.load(os.path.join(partial, column + '.npy'), mmap_mode='r')[:rows]
+                for column in self.columns}
+        timestamps = numpy.array(data[TIMESTAMP])
+        if self.compress:
+            name += _COMPRESSED
+            _replace_atomic(os.path.join(self.path, name), lambda file: numpy.savez_compressed(file, **data))
+            del data
+            shutil.rmtree(partial)
+        else:
+            if rows < self.chunk_rows:
+                for column, array in data.items():
+                    _write_synced(os.path.join(partial, column + '.npy.tmp'),
+                                  lambda file: numpy.lib.format.write_array(file, numpy.asarray(array)))
+            # the memory maps are closed before their files are replaced
+            del data
+            if rows < self.chunk_rows:
+                for column in self.columns:
+                    os.replace(os.path.join(partial, column + '.npy.tmp'), os.path.join(partial, column + '.npy'))
+            os.replace(partial, os.path.join(self.path, name))
+        self.chunks.append(_chunk_entry(name, timestamps, self.compress))
+        self._write_manifest()
+        self._index += 1
+
+    def _write(self, timestamps, columns):
+        done = 0
+        while done < len(timestamps):
+            if self._arrays is None:
+                self._open_chunk()
+            n = min(len(timestamps) - done, self.chunk_rows - self._rows)
+            for name, value in columns.items():
+                self._arrays[name][self._rows:self._rows + n] = value[done:done + n]
+            # timestamps last, a row counts as written once its timestamp is
+            self._arrays[TIMESTAMP][self._rows:self._rows + n] = timestamps[done:done + n]
+            self._rows += n
+            done += n
+            if self._rows == self.chunk_rows:
+                self._flush_chunk()
+                self._seal(self._rows)
+
+    def _flush_chunk(self):
+        for array in self._arrays.values():
+            array.flush()
+
+    def _run(self):
+        try:
+            while True:
+                with self._condition:
+                    self._condition.wait_for(lambda: self._queue or self._closed)
+                    batches = list(self._queue)
+                    self._queue.clear()
+                    self._condition.notify_all()
+                    if not batches and self._closed:
+                        break
+                # every batch queued meanwhile is written with the next pass
+                for timestamps, columns in batches:
+                    self._write(timestamps, columns)
+                with self._condition:
+                    self._pending -= len(batches)
+                    self._condition.notify_all()
+            if self._arrays is not None:
+                self._flush_chunk()
+                self._seal(self._rows)
+        except Exception as e:
+            with self._condition:
+                self._error = e
+                self._condition.notify_all()
+
+
+class MeasurementLog(object):
+    """
+    Read side of a MeasurementSink directory, may be opened while the sink is writing, from another process too.
+    Chunks are memory-mapped when read (loaded when compressed), the rows of a time range are views into them.
+    log = MeasurementLog('soak'); log.read(start, stop)['trace']
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.columns = None
+        self.chunk_list = []
+        self.reload()
+
+    def reload(self):
+        """
+        Pick up chunks sealed since the log was opened.
+        """
+        manifest = _read_manifest(self.path)
+        self.columns = _columns(manifest)
+        self.chunk_list = manifest['chunks']
+
+    def __len__(self):
+        return sum(chunk['rows'] for chunk in self.chunk_list)
+
+    def chunks(self, start=None, stop=None, columns=None):
+        """
+        Rows between start and stop (inclusive) chunk by chunk, including the rows written to the open chunk.
+        The manifest is read again first.
+        :param columns: column names, all if None
+        :return: iterator of {column: array}, views into the memory-mapped chunk files
+        """
+        self.reload()
+        columns = list(self.columns) if columns is None else list(columns)
+        listed = {chunk['name'] for chunk in self.chunk_list}
+        names = [chunk['name'] for chunk in self.chunk_list if chunk['rows']
+                 and (start is None or chunk['stop'] >= start) and (stop is None or chunk['start'] <= stop)]
+        # the open chunk and chunks sealed after the manifest was read
+        names += [name for name in _chunk_names(self.path) if name not in listed]
+        for name in names:
+            try:
+                data = _load_chunk(self.path, name)
+            except FileNotFoundError:
+                # the open chunk was sealed meanwhile
+                continue
+            if not data:
+                continue
+            timestamps = data[TIMESTAMP]
+            low = 0 if start is None else numpy.searchsorted(timestamps, start, 'left')
+            high = len(timestamps) if stop is None else numpy.searchsorted(timestamps, stop, 'right')
+            if high > low:
+                yield {column: data[column][low:high] for column in columns}
+
+    def read(self, start=None, stop=None, columns=None) -> dict:
+        """
+        Rows between start and stop as one array per column, views if they are in one chunk, else copies.
+        """
+        columns = list(self.columns) if columns is None else list(columns)
+        parts = list(self.chunks(start, stop, columns))
+        if len(parts) == 1:
+            return parts[0]
+        if not parts:
+            return {column: numpy.empty((0,) + self.columns[column][1], self.columns[column][0])
+                    for column in columns}
+        return {column: numpy.concatenate([part[column] for part in parts]) for column in columns}
@@ -0,0 +1,281 @@
+import asyncio
+import threading
+import time
+
+import numpy
+
+# what FrameRingBuffer.put does when every slot holds an unread frame
+OverflowPolicy = {
+    'block',  # wait for the consumer, the producer slows down to the consumer's pace
+    'drop_oldest',  # overwrite the oldest unread frame and count it in dropped
+}
+
+
+class FrameRingBuffer(object):
+    """
+    Preallocated ring of fixed size frames with one producer and one consumer thread.
+    The producer writes into the slot returned by reserve() and publishes it with commit().
+    get() returns a view of a slot which stays valid until the next get() call.
+    """
+
+    def __init__(self, depth, shape, dtype=numpy.float64, policy='block'):
+        assert policy in OverflowPolicy
+        assert depth >= 2
+        self.depth = depth
+        self.policy = policy
+        self.frames = numpy.empty((depth,) + tuple(shape), dtype=dtype)
+        self.timestamps = numpy.zeros(depth)
+        self.dropped = 0
+        self._read = 0
+        self._count = 0
+        self._held = False
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def reserve(self, timeout=None) -> numpy.ndarray:
+        """
+        Slot for the next frame, blocks (policy 'block') or drops the oldest frame (policy 'drop_oldest')
+        when the ring is full.
+        """
+        with self._condition:
+            while self._count + self._held >= self.depth and not self._closed:
+                if self.policy == 'drop_oldest' and self._count:
+                    self._read = (self._read + 1) % self.depth
+                    self._count -= 1
+                    self.dropped += 1
+                    break
+                if not self._condition.wait(timeout):
+                    raise TimeoutError('frame ring buffer is full')
+            return self.frames[(self._read + self._count) % self.depth]
+
+    def commit(self, timestamp):
+        with self._condition:
+            self.timestamps[(self._read + self._count) % self.depth] = timestamp
+            self._count += 1
+            self._condition.notify_all()
+
+    def put(self, timestamp, frame, timeout=None):
+        self.reserve(timeout)[...] = frame
+        self.commit(timestamp)
+
+    def get(self, timeout=None):
+        """
+        :return: (timestamp, frame view), or None if the ring was closed and is empty
+        """
+        with self._condition:
+            if self._held:
+                self._held = False
+                self._condition.notify_all()
+            while not self._count:
+                if self._closed:
+                    return None
+                if not self._condition.wait(timeout):
+                    raise TimeoutError('no frame received')
+            index = self._read
+            self._read = (self._read + 1) % self.depth
+            self._count -= 1
+            self._held = True
+            return self.timestamps[index], self.frames[index]
+
+    def close(self):
+        """
+        No more frames will be put, get() returns None once the ring is empty
+        and reserve() no longer waits for free slots.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def __len__(self):
+        return self._count
+
+
+class SweepStream(object):
+    """
+    Repeated single sweeps of one VNA trace, acquired on a background thread.
+    Iterating (or async iterating) yields (timestamp, ndarray) frames as returned by
+    Format.get_format_data_ndarray(), which are views into a preallocated ring buffer
+    that stay valid until the next frame is requested.
+    While the instrument runs sweep N+1 the host copies sweep N into the ring buffer.
+    The stream is stopped when the loop ends or is left early (break, exception), an async loop
+    also starts it in the executor instead of blocking the event loop.
+    """
+
+    def __init__(self, vna, cnum=1, tnum=1, count=None, depth=8, policy='block', timeout=None, sweep_timeout=None):
+        """
+        :param vna: SiglentVNA
+        :param count: number of sweeps, endless if None
+        :param depth: frames in the ring buffer
+        :param policy: 'block' or 'drop_oldest', see OverflowPolicy
+        :param timeout: seconds to wait for a frame, forever if None
+        :param sweep_timeout: seconds to wait for one sweep, the session timeout if None
+        """
+        self.vna = vna
+        self.cnum = cnum
+        self.tnum = tnum
+        self.count = count
+        self.depth = depth
+        self.policy = policy
+        self.timeout = timeout
+        self.sweep_timeout = sweep_timeout
+        self.frequency = None
+        self.ring = None
+        # (source, continuous) before start(), restored by stop()
+        self._trigger = None
+        self._ready = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._error = None
+
+    @property
+    def dropped(self) -> int:
+        return self.ring.dropped if self.ring is not None else 0
+
+    def start(self):
+        if self._thread is not None:
+            return self
+        self.frequency = numpy.array(self.vna.format.get_channel_frequency_ndarray(self.cnum))
+        self._trigger = (self.vna.trigger.get_source(), self.vna.trigger.get_continuous(self.cnum))
+        self.vna.trigger.set_continuous(self.cnum, True)
+        self.vna.trigger.set_source('bus')
+        self._thread = threading.Thread(target=self._run, name=f'SweepStream-{self.cnum}-{self.tnum}', daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self.ring is not None:
+            self.ring.close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+            source, continuous = self._trigger
+            self.vna.trigger.set_source(source)
+            self.vna.trigger.set_continuous(self.cnum, continuous)
+
+    def _run(self):
+        try:
+            self._sweep()
+            raw = self._fetch()
+            self.ring = FrameRingBuffer(self.depth, raw.shape, raw.dtype, self.policy)
+            self._ready.set()
+            n = 0
+            while not self._stop.is_set():
+                timestamp = time.time()
+                n += 1
+                last = self.count is not None and n >= self.count
+                if not last:
+                    self.vna.trigger.single()
+                self.ring.reserve()[...] = raw
+                self.ring.commit(timestamp)
+                if last:
+                    break
+                self.vna.wait_operation_complete(self.sweep_timeout)
+                raw = self._fetch()
+        except Exception as e:
+            self._error = e
+        finally:
+            self._ready.set()
+            if self.ring is not None:
+                self.ring.close()
+
+    def _sweep(self):
+        self.vna.trigger.single()
+        self.vna.wait_operation_complete(self.sweep_timeout)
+
+    def _fetch(self):
+        return self.vna.format.get_format_data_ndarray(self.cnum, self.tnum)
+
+    def _next(self):
+        frame = self.ring.get(self.timeout) if self.ring is not None else None
+        if frame is None and self._error is not None:
+            raise self._error
+        return frame
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def __iter__(self):
+        self.start()
+        try:
+            while True:
+                frame = self._next()
+                if frame is None:
+                    return
+                yield frame
+        finally:
+            self.stop()
+
+    async def __aiter__(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.start)
+        try:
+            while True:
+                frame = await loop.run_in_executor(None, self._next)
+                if frame is None:
+                    return
+                yield frame
+        finally:
+            await loop.run_in_executor(None, self.stop)
+
+
+class SampleRingBuffer(object):
+    """
+    Preallocated ring of (timestamp, value) samples with one writer and one reader thread.
+    When full the oldest samples are overwritten and counted in dropped.
+    """
+
+    def __init__(self, capacity, dtype=numpy.float64):
+        self.capacity = capacity
+        self.values = numpy.empty(capacity, dtype=dtype)
+        self.timestamps = numpy.empty(capacity)
+        self.dropped = 0
+        self._write = 0
+        self._count = 0
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def put(self, timestamps, values):
+        n = len(values)
+        if n > self.capacity:
+            self.dropped += n - self.capacity
+            timestamps, values = timestamps[-self.capacity:], values[-self.capacity:]
+            n = self.capacity
+        with self._condition:
+            first = min(n, self.capacity - self._write)
+            self.values[self._write:self._write + first] = values[:first]
+            self.timestamps[self._write:self._write + first] = timestamps[:first]
+            self.values[:n - first] = values[first:]
+            self.timestamps[:n - first] = timestamps[first:]
+            self._write = (self._write + n) % self.capacity
+            overflow = self._count + n - self.capacity
+            if overflow > 0:
+                self.dropped += overflow
+            self._count = min(self._count + n, self.capacity)
+            self._condition.notify_all()
+
+    def get(self, n=None, timeout=None):
+        """
+        Remove and return up to n samples (all available if None), waiting up to timeout for n of them.
+        :return: (timestamps, values) copies, possibly shorter than n after a timeout or close()
+        """
+        with self._condition:
+            if n is not None:
+                self._condition.wait_for(lambda: self._count >= n or self._closed, timeout)
+            count = self._count if n is None else min(n, self._count)
+            start = (self._write - self._count) % self.capacity
+            index = (start + numpy.arange(count)) % self.capacity
+            self._count -= count
+            return self.timestamps[index], self.values[index]
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def __len__(self):
+        return self._count
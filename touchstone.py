@@ -0,0 +1,142 @@
+import contextlib
+import os
+import re
+
+import numpy
+
+# data formats of a Touchstone option line
+TouchstoneFormat = {'RI', 'MA', 'DB'}
+
+FrequencyUnit = {
+    'HZ': 1.0,
+    'KHZ': 1e3,
+    'MHZ': 1e6,
+    'GHZ': 1e9,
+}
+
+# rows formatted per write() call when streaming to disk
+WRITE_CHUNK_ROWS = 4096
+
+
+def _column_order(nports):
+    """
+    Order of the (i, j) matrix elements on a data line. Touchstone 1.x lists 2-port data as
+    S11 S21 S12 S22 and every other port count row by row.
+    """
+    if nports == 2:
+        return [(0, 0), (1, 0), (0, 1), (1, 1)]
+    return [(i, j) for i in range(nports) for j in range(nports)]
+
+
+def _pairs(s, fmt):
+    if fmt == 'RI':
+        return s.real, s.imag
+    angle = numpy.degrees(numpy.angle(s))
+    if fmt == 'MA':
+        return numpy.abs(s), angle
+    with numpy.errstate(divide='ignore'):
+        return 20 * numpy.log10(numpy.abs(s)), angle
+
+
+def _complex(a, b, fmt):
+    if fmt == 'RI':
+        return a + 1j * b
+    if fmt == 'DB':
+        a = 10 ** (a / 20)
+    return a * numpy.exp(1j * numpy.radians(b))
+
+
+def write_touchstone(file, frequency, s, fmt='RI', z0=50.0, unit='HZ', comments=()):
+    """
+    Write a Touchstone 1.x file.
+    :param file: path or text file object
+    :param frequency: frequencies in Hz, shape (points,)
+    :param s: complex S-parameters, shape (points, nports, nports), or (points,) for one port
+    :param fmt: 'RI', 'MA' or 'DB'
+    :param z0: reference impedance in ohms
+    :param unit: frequency unit of the file, a key of FrequencyUnit
+    :param comments: lines written as '!' comments before the option line
+    """
+    fmt = fmt.upper()
+    unit = unit.upper()
+    assert fmt in TouchstoneFormat
+    assert unit in FrequencyUnit
+    frequency = numpy.asarray(frequency, dtype=numpy.float64)
+    s = numpy.asarray(s)
+    if s.ndim == 1:
+        s = s.reshape(-1, 1, 1)
+    points, nports, _ = s.shape
+    assert frequency.shape == (points,)
+
+    order = _column_order(nports)
+    a, b = _pairs(s[:, [i for i, _ in order], [j for _, j in order]], fmt)
+    values = numpy.empty((points, 1 + 2 * len(order)))
+    values[:, 0] = frequency / FrequencyUnit[unit]
+    values[:, 1::2] = a
+    values[:, 2::2] = b
+
+    # 3 and 4 port data is written one matrix row per line
+    pairs_per_line = nports if nports > 2 else len(order)
+    lines = ['%.10g' + ' %.9g %.9g' * pairs_per_line]
+    lines += [' ' + ' %.9g %.9g' * pairs_per_line] * (nports - 1 if nports > 2 else 0)
+    row_format = '\n'.join(lines) + '\n'
+
+    with _open(file, 'w') as f:
+        for comment in comments:
+            f.write(f'! {comment}\n')
+        f.write(f'# {unit} S {fmt} R {z0:g}\n')
+        for start in range(0, points, WRITE_CHUNK_ROWS):
+            chunk = values[start:start + WRITE_CHUNK_ROWS]
+            f.write((row_format * len(chunk)) % tuple(chunk.ravel()))
+
+
+def read_touchstone(file, nports=None):
+    """
+    Read a Touchstone 1.x file, all numbers are converted in one vectorized step.
+    :param file: path or text file object
+    :param nports: port count, taken from the .sNp extension of a path if None
+    :return: (frequency in Hz, complex S-parameters shaped (points, nports, nports), z0)
+    """
+    if nports is None:
+        match = re.search(r'\.s(\d+)p$', str(getattr(file, 'name', file)), re.IGNORECASE)
+        assert match, 'port count is needed for a file without a .sNp extension'
+        nports = int(match.group(1))
+    with _open(file, 'r') as f:
+        text = f.read()
+
+    unit, fmt, z0 = 'GHZ', 'MA', 50.0
+    data = []
+    for line in text.splitlines():
+        line = line.split('!', 1)[0].strip()
+        if not line:
+            continue
+        if line.startswith('#'):
+            options = line[1:].upper().split()
+            for i, option in enumerate(options):
+                if option in FrequencyUnit:
+                    unit = option
+                elif option in TouchstoneFormat:
+                    fmt = option
+                elif option == 'R':
+                    z0 = float(options[i + 1])
+            continue
+        data.append(line)
+
+    order = _column_order(nports)
+    values = numpy.array(' '.join(data).split(), dtype=numpy.float64).reshape(-1, 1 + 2 * len(order))
+    frequency = values[:, 0] * FrequencyUnit[unit]
+    s = numpy.empty((len(values), nports, nports), dtype=numpy.complex128)
+    s[:, [i for i, _ in order], [j for _, j in order]] = _complex(values[:, 1::2], values[:, 2::2], fmt)
+    return frequency, s, z0
+
+
+@contextlib.contextmanager
+def _open(file, mode):
+    """
+    Open a path, or pass an already open file object through without closing it.
+    """
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, mode) as f:
+            yield f
+    else:
+        yield file